@@ -1,16 +1,26 @@
 
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import chess
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify, url_for, Response, stream_with_context, send_file
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
-import requests
-
-from forms import RegisterForm, LoginForm, PostGameForm, TagForm, SearchGamesForm, UserProfileForm
+from forms import RegisterForm, LoginForm, PostGameForm, ImportGameForm, UploadPGNForm, TagForm, SearchGamesForm, UserProfileForm
 
 # from forms import EditProfileForm, UserAddForm, LoginForm, MessageForm
-from models import db, connect_db, User, Game, Like, Tag, GameTag, GameTagLikes
+from models import db, connect_db, User, Game, Tag, ArchivedGame, ImportJob, repair_counters, classify_openings
+import feed
+import votes
+import tag_catalog
+import chesscom
+import jobs
+import pgn_tools
+import explorer
+import bulk
+import exports
+import thumbnails
 
 CURR_USER_KEY = "curr_user"
 
@@ -25,11 +35,74 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 25))
+app.config['FEED_MAX_PAGE_SIZE'] = int(os.environ.get('FEED_MAX_PAGE_SIZE', 100))
+app.config['TAG_CATALOG_CHECK_SECONDS'] = float(os.environ.get('TAG_CATALOG_CHECK_SECONDS', 5))
+app.config['CHESSCOM_CACHE_DIR'] = os.environ.get(
+    'CHESSCOM_CACHE_DIR', os.path.join(app.instance_path, 'chesscom'))
+app.config['CHESSCOM_TIMEOUT'] = float(os.environ.get('CHESSCOM_TIMEOUT', 10))
+app.config['CHESSCOM_MAX_CONNECTIONS'] = int(os.environ.get('CHESSCOM_MAX_CONNECTIONS', 4))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 64)) * 1024 * 1024
+app.config['UPLOAD_BATCH_SIZE'] = int(os.environ.get('UPLOAD_BATCH_SIZE', 200))
+# 0 means one PGN parser process per core
+app.config['PGN_PROCESSES'] = int(os.environ.get('PGN_PROCESSES', 0)) or None
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', 1))
+app.config['JOB_STALE_SECONDS'] = int(os.environ.get('JOB_STALE_SECONDS', 300))
+app.config['THUMBNAIL_DIR'] = os.environ.get(
+    'THUMBNAIL_DIR', os.path.join(app.instance_path, 'thumbnails'))
 
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+
+@app.cli.command('repair-counts')
+def repair_counts_command():
+    """Rebuild the like and tag counters and games.username from their tables."""
+
+    repair_counters()
+    print('like and tag counters and game usernames rebuilt')
+
+
+@app.cli.command('backfill-pgns')
+@click.option('--all', 'everything', is_flag=True, help='Reparse every game, not just ones missing data.')
+@click.option('--processes', type=int, help='Parser processes (default: one per core).')
+def backfill_pgns_command(everything, processes):
+    """Fill in games.pgn_hash and the pgn header columns for older games."""
+
+    updated, duplicates, unreadable = bulk.backfill_pgns(everything=everything,
+                                                         processes=processes or app.config['PGN_PROCESSES'])
+    print(f'updated {updated} games')
+    if duplicates:
+        print(f'left unhashed, same moves as an earlier game by the same user: {duplicates}')
+    if unreadable:
+        print(f'skipped, pgn could not be read: {unreadable}')
+
+
+@app.cli.command('classify-openings')
+def classify_openings_command():
+    """Name every game's opening from the ECO trie."""
+
+    print(f'classified {classify_openings()} games')
+
+
+@app.cli.command('rebuild-explorer')
+def rebuild_explorer_command():
+    """Recount the opening explorer from every game's positions."""
+
+    explorer.rebuild()
+    print('opening explorer rebuilt')
+
+
+@app.cli.command('import-worker')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty.')
+def import_worker_command(once):
+    """Run queued chess.com imports and .pgn uploads."""
+
+    jobs.work(poll_interval=app.config['JOB_POLL_SECONDS'],
+              stale_after=app.config['JOB_STALE_SECONDS'],
+              once=once)
+
 ##############################################################################
 # User signup/login/logout
 
@@ -123,178 +196,108 @@ def logout():
 ##############################################################################
 ## HOME ROUTE ###
 
+def feed_page_size():
+    """page size for the home feed, optionally overridden by ?per_page="""
+
+    per_page = request.args.get('per_page', type=int) or app.config['FEED_PAGE_SIZE']
+    return max(1, min(per_page, app.config['FEED_MAX_PAGE_SIZE']))
+
+
+def next_page_url(cursor):
+    """url for the page after `cursor`, keeping the current query string"""
+
+    if not cursor:
+        return None
+
+    args = request.args.to_dict(flat=False)
+    args['after'] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+def render_feed(sort, query=None, export_urls=None):
+    """renders one keyset page of the home feed in the given sort order,
+    optionally narrowed to a filtered Game query, with download links for
+    all of its games if `export_urls` are given"""
+
+    if not g.user:
+        return redirect('/signup')
+
+    try:
+        games, next_cursor = feed.page(sort, after=request.args.get('after'), per_page=feed_page_size(), query=query)
+    except feed.InvalidCursor:
+        flash('invalid page', 'danger')
+        return redirect(request.path)
+
+    tags = tag_catalog.get_tags()
+
+    return render_template("home.html", user=g.user, games=games, tags=tags, next_url=next_page_url(next_cursor),
+                           export_urls=export_urls)
+
 @app.route('/', methods=['GET','POST'])
 def home():
     """ Renders homepage view game posts"""
 
-    if g.user:
-            games = Game.query.all()
-            tags = Tag.query.all()
-       
-            return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('newest')
 
 @app.route('/newest')
 def home_sort_newest():
     """sorts homepage by newest post"""
-    if g.user:
-        games = Game.query.order_by(Game.timestamp.desc()).all()
-        tags = Tag.query.all()
-    
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
 
-    return redirect('/signup')
+    return render_feed('newest')
 
 @app.route('/oldest')
 def home_sort_oldest():
     """sorts homepage by oldest post"""
 
-    if g.user:
-        games = Game.query.order_by(Game.timestamp).all()
-        tags = Tag.query.all()
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
- 
+    return render_feed('oldest')
 
 @app.route('/by_user_A_Z')
 def home_sort_user_a_z():
     """sorts homepage by user a first"""
 
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
-
-        def sort_by_username(e):
-            return e.users.username
-
-        games.sort(key=sort_by_username)
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('user_a_z')
 
 @app.route('/by_user_Z_A')
 def home_sort_user_z_a():
     """sorts homepage by user a last"""
 
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
-
-        def sort_by_username(e):
-            return e.users.username
-
-        games.sort(key=sort_by_username, reverse=True)
-
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('user_z_a')
 
 @app.route('/by_title_A_Z')
 def home_sort_title_a_z():
     """sorts homepage by post title a first"""
 
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
-
-        def sort_by_title(e):
-            return e.title.lower()
-        
-        games.sort(key=sort_by_title)
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('title_a_z')
 
 @app.route('/by_title_Z_A')
 def home_sort_title_z_a():
     """sorts homepage by title a last"""
-    
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
 
-        def sort_by_title(e):
-            return e.title.lower()
-        
-        games.sort(key=sort_by_title, reverse=True)
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('title_z_a')
 
 @app.route('/by_most_likes')
 def home_sort_most_likes():
     """sorts homepage by most likes"""
-    
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
 
-        def sort_by_most_likes(e):
-            return len(e.likes)
-        
-        games.sort(key=sort_by_most_likes, reverse=True)
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('most_likes')
 
 @app.route('/by_least_likes')
 def home_sort_least_likes():
-    """sorts homepage by most likes"""
-    
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
-
-        def sort_by_least_likes(e):
-            return len(e.likes)
-        
-        games.sort(key=sort_by_least_likes)
+    """sorts homepage by least likes"""
 
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('least_likes')
 
 @app.route('/by_most_tags')
 def home_sort_most_tags():
     """sorts homepage by most unique tags"""
-    
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
-
-        def sort_by_most_tags(e):
-            return len(e.game_tags)
-        
-        games.sort(key=sort_by_most_tags, reverse=True)
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
 
-    return redirect('/signup')
+    return render_feed('most_tags')
 
 @app.route('/by_least_tags')
 def home_sort_least_tags():
-    """sorts homepage by most unique tags"""
-    
-    if g.user:
-        games = Game.query.all()
-        tags = Tag.query.all()
+    """sorts homepage by least unique tags"""
 
-        def sort_by_least_tags(e):
-            return len(e.game_tags)
-        
-        games.sort(key=sort_by_least_tags)
-
-        return render_template("home.html", user=g.user, games=games, likes=g.user.likes, tags=tags)
-
-    return redirect('/signup')
+    return render_feed('least_tags')
 
 
 
@@ -341,6 +344,55 @@ def edit_user_profile():
 ####################################################################
 ### GAME ROUTES ####
 
+def export_response(query, fmt, name):
+    """streams the games in `query` as an attachment, gzipped on the fly
+    when the client accepts it"""
+
+    if fmt not in exports.FORMATS:
+        abort(404)
+
+    compress = request.accept_encodings['gzip'] > 0
+    body = exports.stream(query, fmt, compress=compress)
+
+    response = Response(stream_with_context(body), mimetype=exports.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}.{fmt}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def export_urls(endpoint, **values):
+    """{format: url} for an export route"""
+
+    return {fmt: url_for(endpoint, fmt=fmt, **values) for fmt in exports.FORMATS}
+
+def commit_game(game):
+    """commits a new or edited game unless its user already has a game with
+    the same moves; returns that game instead, or None once committed.
+
+    the opening explorer is moved from the game's old moves to its new ones
+    in the same transaction
+    """
+
+    user_id, pgn_hash, game_id = game.user_id, game.pgn_hash, game.id
+
+    duplicate = Game.find_duplicate(user_id, pgn_hash, game_id)
+    if duplicate is None:
+        try:
+            if game_id is not None:
+                explorer.remove_game(game_id)
+            db.session.flush()
+            explorer.add_game(game.id)
+            db.session.commit()
+            return None
+        except IntegrityError:
+            # the same game was saved by another request in the meantime
+            db.session.rollback()
+            return Game.find_duplicate(user_id, pgn_hash, game_id)
+
+    db.session.rollback()
+    return duplicate
+
 @app.route('/games/<user_id>/')
 def show_user_games(user_id):
     """button to add a new game at top. 
@@ -351,9 +403,21 @@ def show_user_games(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    games = Game.query.filter(Game.user_id == user_id).all()
+    games = feed.load_cards(Game.query.filter(Game.user_id == user_id).order_by(Game.id).all())
+
+    return render_template('users/games.html', user=user, games=games,
+                           export_urls=export_urls('export_user_games', user_id=user.id))
+
+@app.route('/games/<int:user_id>/export.<fmt>')
+def export_user_games(user_id, fmt):
+    """a user's posted games as one .pgn or .ndjson file"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    return render_template('users/games.html', user=user, games=games)
+    user = User.query.get_or_404(user_id)
+    return export_response(Game.query.filter(Game.user_id == user.id), fmt, f'{user.username}-games')
 
 @app.route('/games/game/<game_id>')
 def show_game(game_id):
@@ -364,6 +428,64 @@ def show_game(game_id):
     game = Game.query.get_or_404(game_id)
     return render_template('users/game.html', game=game, user=g.user)
 
+@app.template_global()
+def thumbnail_url(game):
+    """versioned url of a game's (or FeedGame's) thumbnail"""
+
+    return url_for('game_thumbnail', game_id=game.id, v=thumbnails.version(game))
+
+@app.route('/games/game/<int:game_id>/thumbnail.svg')
+def game_thumbnail(game_id):
+    """SVG of the game's final position, drawn once and then read from disk.
+    Feed cards ask for it with ?v=<thumbnails.version>, which changes when
+    the game is edited, so browsers can keep those for good"""
+
+    if not g.user:
+        abort(401)
+
+    game = Game.query.get_or_404(game_id)
+    try:
+        path = thumbnails.thumbnail(app.config['THUMBNAIL_DIR'], game)
+    except pgn_tools.InvalidPGN:
+        abort(404)
+
+    versioned = request.args.get('v') == thumbnails.version(game)
+    return send_file(path, mimetype='image/svg+xml', conditional=True,
+                     cache_timeout=thumbnails.MAX_AGE if versioned else 0)
+
+@app.route('/games/game/<int:game_id>/moves')
+def game_moves(game_id):
+    """JSON move list of a game (see pgn_tools.position_at), or with ?ply=
+    just the position after that many plies"""
+
+    if not g.user:
+        return jsonify(error='unauthorized'), 401
+
+    row = db.session.query(Game.moves, Game.pgn).filter(Game.id == game_id).first()
+    if row is None:
+        return jsonify(error='game not found'), 404
+
+    moves = row.moves
+    if moves is None:
+        # saved before move lists; backfill-pgns stores it
+        try:
+            moves = pgn_tools.summarize(row.pgn).moves
+        except pgn_tools.InvalidPGN:
+            return jsonify(error="this game's PGN can't be read"), 404
+
+    ply = request.args.get('ply', type=int)
+    if 'ply' not in request.args:
+        return jsonify(game_id=game_id, **moves)
+
+    try:
+        fen = pgn_tools.position_at(moves, ply if ply is not None else -1)
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+
+    return jsonify(game_id=game_id, ply=ply, fen=fen,
+                   san=moves['san'][ply - 1] if ply else None,
+                   uci=moves['uci'][ply - 1] if ply else None)
+
 
 @app.route('/games/game/<game_id>/delete', methods=['POST'])
 def delete_game(game_id):
@@ -371,8 +493,10 @@ def delete_game(game_id):
 
     game = Game.query.get_or_404(game_id)
     if int(g.user.id) == int(game.user_id):
+        explorer.remove_game(game.id)
         db.session.delete(game)
         db.session.commit()
+        thumbnails.discard(app.config['THUMBNAIL_DIR'], game.id)
         
         flash('game deleted', 'danger')
         return redirect('/')
@@ -387,10 +511,14 @@ def edit_game(game_id):
     form = PostGameForm(obj=game)
 
     if form.validate_on_submit():
-        game.pgn = form.pgn.data
+        game.set_pgn(form.pgn.data, summary=form.summary)
         game.title = form.title.data
-        db.session.commit()
-        
+
+        duplicate = commit_game(game)
+        if duplicate:
+            flash(f'you already posted this game as "{duplicate.title}"', 'danger')
+            return redirect(url_for('show_game', game_id=duplicate.id))
+
         flash('pgn updated', 'success')
         return redirect(f'/games/{g.user.id}')
 
@@ -406,91 +534,240 @@ def add_game():
         return redirect("/")
 
     form = PostGameForm()
-    tags = Tag.query.all()
+    tags = tag_catalog.get_tags()
 
     if form.validate_on_submit():
-        pgn = form.pgn.data
-        title = form.title.data
-        game = Game(pgn=pgn, user_id=g.user.id, title=title)
+        game = Game(user_id=g.user.id, username=g.user.username, title=form.title.data)
+        game.set_pgn(form.pgn.data, summary=form.summary)
 
         db.session.add(game)
-        db.session.commit()
+        duplicate = commit_game(game)
+        if duplicate:
+            flash(f'you already posted this game as "{duplicate.title}"', 'danger')
+            return redirect(url_for('show_game', game_id=duplicate.id))
 
         flash('game added')
         return render_template('users/tag_new_game.html', tags=tags, game=game, user = g.user)
 
     return render_template('users/post_game.html', form=form, user=g.user, tags=tags)
 
+@app.route('/games/upload', methods=['GET', 'POST'])
+def upload_games():
+    """post every game in an uploaded .pgn file.
+
+    the file is copied into upload_chunks and parsed by the import worker,
+    so a large upload never ties up a web worker; the page polls the job
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = UploadPGNForm()
+
+    if form.validate_on_submit():
+        upload = form.pgn.data
+
+        def spool(job):
+            job.result_url = url_for('show_upload_report', job_id=job.id)
+            bulk.spool_upload(job.id, upload.stream)
+
+        job = jobs.enqueue('pgn_upload', {'filename': upload.filename}, user_id=g.user.id, attach=spool)
+        return redirect(url_for('show_job', job_id=job.id))
+
+    return render_template('users/upload_games.html', form=form, report=None, user=g.user)
+
+@app.route('/games/upload/<int:job_id>')
+def show_upload_report(job_id):
+    """what happened to each game of a finished upload"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    job = ImportJob.query.get_or_404(job_id)
+    if job.user_id != g.user.id or job.kind != 'pgn_upload':
+        abort(404)
+
+    return render_template('users/upload_games.html', form=UploadPGNForm(), report=job.result, user=g.user)
+
 @app.route('/games/find', methods=['GET', 'POST'])
 def find_games():
-    
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
     form = SearchGamesForm()
     if form.validate_on_submit():
         print('form validating')
 
-        base_url = 'https://api.chess.com/pub/player'
-        username = form.username.data
+        username = form.username.data.strip().lower()
         year = form.year.data
         month = form.month.data
         offset = form.offset.data
         limit = form.limit.data
+        filters = dict(time_class=form.time_class.data or None,
+                       color=form.color.data or None,
+                       result=form.result.data or None,
+                       min_opponent_rating=form.min_opponent_rating.data,
+                       max_opponent_rating=form.max_opponent_rating.data)
+
+        if form.whole_history.data:
+            year = month = None
+        elif year is None or month is None:
+            flash('pick a year and month, or search the whole history', 'danger')
+            return render_template('users/find_games.html', form=form, user=g.user)
+        else:
+            # a finished month already on disk costs no network, so show it now
+            archive = chesscom.get_client().cached_archive(username, year, month)
+            if archive is not None:
+                json_games = chesscom.archive_window(archive, username, offset=offset, limit=limit, **filters)
+                # keep the shown games so import_game can find them by uuid
+                chesscom.store_games(username, json_games)
+                return render_template('users/search_games.html', json_games=json_games,
+                                       username=username)
+
+        # anything that needs chess.com runs on the import worker
+        result_url = url_for('show_archived_games', username=username, year=year, month=month,
+                             offset=offset, limit=limit, **filters)
+        job = jobs.enqueue('chesscom_history', {'username': username, 'year': year, 'month': month},
+                           user_id=g.user.id, result_url=result_url)
+
+        return redirect(url_for('show_job', job_id=job.id))
+
+    return render_template('users/find_games.html', form=form, user=g.user)
 
+@app.route('/games/find/<username>/history')
+def show_archived_games(username):
+    """page through a player's stored chess.com history.
 
-        url = f'{base_url}/{username}/games/{year}/{month:02d}'
+    takes the same offset, limit and filters as the find games form
+    """
 
-        resp = requests.get(url=url)
-        data = resp.json()
-        json_games= data['games']
-    
-        return render_template('users/search_games.html', json_games=json_games, offset=offset, limit=offset+limit)
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    return render_template('users/find_games.html', form=form, user=g.user)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+
+    query = chesscom.stored_games(
+        username,
+        year=request.args.get('year', type=int),
+        month=request.args.get('month', type=int),
+        time_class=request.args.get('time_class') or None,
+        color=request.args.get('color') or None,
+        result=request.args.get('result') or None,
+        min_opponent_rating=request.args.get('min_opponent_rating', type=int),
+        max_opponent_rating=request.args.get('max_opponent_rating', type=int))
+    json_games = query.offset(offset).limit(limit).all()
+
+    next_url = None
+    if len(json_games) == limit:
+        args = request.args.to_dict()
+        args['offset'] = offset + limit
+        next_url = url_for('show_archived_games', username=username, **args)
+
+    return render_template('users/search_games.html', json_games=json_games, next_url=next_url,
+                           username=username.strip().lower())
+
+@app.route('/games/find/<username>/<uuid>.pgn')
+def archived_game_pgn(username, uuid):
+    """the pgn of one stored chess.com game; the search results only show
+    players and ratings, and fetch this when a board is opened"""
+
+    if not g.user:
+        abort(401)
 
-@app.route('/games/import', methods=['GET', 'POST'])
+    archived = ArchivedGame.query.filter_by(username=username.strip().lower(), uuid=uuid).first_or_404()
+    return Response(archived.pgn, mimetype=exports.FORMATS['pgn'])
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    """JSON progress of one of the user's import jobs"""
+
+    if not g.user:
+        return jsonify(error='unauthorized'), 401
+
+    job = ImportJob.query.get(job_id)
+    if job is None or job.user_id != g.user.id:
+        return jsonify(error='job not found'), 404
+
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<int:job_id>/status')
+def show_job(job_id):
+    """page that polls job_status until the import is done"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    job = ImportJob.query.get_or_404(job_id)
+    if job.user_id != g.user.id:
+        abort(404)
+
+    return render_template('users/import_status.html', job=job, user=g.user)
+
+@app.route('/games/import', methods=['POST'])
 def import_game():
-    if request.form['pgn']:
-        pgn_data = request.form['pgn']
-    
-    game = Game(pgn=pgn_data)
-    form = PostGameForm(obj=game)
+    """post a game picked from the search results.
+
+    the results only send back the game's chess.com uuid; the pgn comes from
+    the games stored in chesscom_games when the search ran
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = ImportGameForm()
+    archived = ArchivedGame.query.filter_by(username=(form.username.data or '').strip().lower(),
+                                            uuid=form.uuid.data).first()
+    if archived is None:
+        flash('pick a game from the search results to import', 'danger')
+        return redirect(url_for('find_games'))
 
     if form.validate_on_submit():
-        pgn = form.pgn.data
-        title = form.title.data
-    
-        
-        game = Game(pgn=pgn, user_id=g.user.id, title=title)
+        game = Game(user_id=g.user.id, username=g.user.username, title=form.title.data)
+        try:
+            game.set_pgn(archived.pgn)
+        except pgn_tools.InvalidPGN as exc:
+            flash(str(exc), 'danger')
+            return redirect(url_for('find_games'))
+
         db.session.add(game)
-        db.session.commit()
+        duplicate = commit_game(game)
+        if duplicate:
+            flash(f'you already posted this game as "{duplicate.title}"', 'danger')
+            return redirect(url_for('show_game', game_id=duplicate.id))
 
-        tags= Tag.query.all()
+        tags= tag_catalog.get_tags()
         game = Game.query.get_or_404(game.id)
 
         flash('imported game posted')
         return render_template('users/tag_new_game.html', tags=tags, game=game, user = g.user)
 
+    return render_template('users/post_game.html', form=form, user=g.user, pgn=archived.pgn)
 
-    return render_template('users/post_game.html', form=form, user=g.user, tags=Tag.query.all())
-
-@app.route('/games/new/<game_id>/add_tags', methods=['POST'])
+@app.route('/games/new/<int:game_id>/add_tags', methods=['POST'])
 def add_tags_to_new_game(game_id):
+    """apply the tags checked on the new game form, with the poster's vote"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    tag_ids = request.form.getlist('tag_id', type=int)
+
+    try:
+        votes.tag_new_game(g.user.id, game_id, tag_ids)
+    except IntegrityError:
+        # unknown game or tag
+        db.session.rollback()
+        abort(404)
 
-    for tag in Tag.query.all():
-    
-        if bool(request.form.get(tag.name)) == True:
-         
-            tag_id = int(request.form.get(tag.name))
-            game_tag = GameTag(game_id=game_id, tag_id=tag_id)
-            db.session.add(game_tag)
-            db.session.commit()
-            game_tag_like = GameTagLikes(game_tag_id=game_tag.id, user_id=g.user.id)
-            db.session.add(game_tag_like)
-            db.session.commit()
-            print('game tagged HERE')
-            continue;
-       
-            
-       
     flash('game added and tagged')
     return redirect('/')
 
@@ -498,7 +775,7 @@ def add_tags_to_new_game(game_id):
 def add_tags_to_new_post(game_id):
 
     game = Game.query.get_or_404(game_id)
-    tags = Tag.query.all()
+    tags = tag_catalog.get_tags()
 
     if request.post:
         # tags = request.form.get('tags')
@@ -514,58 +791,107 @@ def add_tags_to_new_post(game_id):
 
 @app.route('/likes')
 def show_user_likes():
-    games = g.user.likes
-    return render_template ('/users/likes.html', games=games, user=g.user, likes = g.user.likes)
+    games = feed.liked_cards(g.user.id)
+    return render_template ('/users/likes.html', games=games, user=g.user, tags=tag_catalog.get_tags(),
+                            export_urls=export_urls('export_user_likes'))
+
+@app.route('/likes/export.<fmt>')
+def export_user_likes(fmt):
+    """the user's liked games as one .pgn or .ndjson file"""
 
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
+    return export_response(feed.liked_games(g.user.id), fmt, f'{g.user.username}-likes')
 
-@app.route('/users/delete_like/<game_id>', methods=['POST'])
+
+
+@app.route('/users/delete_like/<int:game_id>', methods=['POST'])
 def delete_like(game_id):
     if g.user:
-        for like in Like.query.all():
-            if int(like.game_id) == int(game_id) and int(like.user_id) == int(g.user.id):
+        state = votes.unlike_game(g.user.id, game_id)
+        if state.like_count is None:
+            abort(404)
 
-                db.session.delete(like)
-                db.session.commit()
-
-                flash('like removed', 'danger')
-                return redirect(request.referrer)
-        
-        flash('you havent liked this post')
+        if state.changed:
+            flash('like removed', 'danger')
+        else:
+            flash('you havent liked this post')
         return redirect(request.referrer)
 
     flash('unauthorized', 'danger')
     return redirect('/')
 
-@app.route('/users/add_like/<game_id>', methods=['POST'])
+@app.route('/users/add_like/<int:game_id>', methods=['POST'])
 def add_like(game_id):
     if g.user:
-        counter = 0
-        for like in Like.query.all():
-            if int(like.game_id) == int(game_id) and int(like.user_id) == int(g.user.id):
-                counter += 1
-
-        if counter < 1:
-            new_like = Like(user_id = g.user.id, game_id = game_id )
-            db.session.add(new_like)
-            db.session.commit()
+        try:
+            state = votes.like_game(g.user.id, game_id)
+        except IntegrityError:
+            # no such game
+            db.session.rollback()
+            abort(404)
+
+        if state.changed:
             flash('post liked', 'success')
-            return redirect(request.referrer)
         else:
             flash('You already liked this post')
-            return redirect(request.referrer)
+        return redirect(request.referrer)
+
     flash('acesss unauthorized')
     return redirect('/')
 
   
 
+####################################################################
+### JSON API ROUTES ####
+# used by static/js/script.js to like and tag without re-rendering the feed
+
+@app.route('/api/games/<int:game_id>/like', methods=['POST', 'DELETE'])
+def api_like(game_id):
+    """POST likes a game, DELETE unlikes it; returns the new like state"""
+
+    if not g.user:
+        return jsonify(error='unauthorized'), 401
+
+    try:
+        if request.method == 'POST':
+            state = votes.like_game(g.user.id, game_id)
+        else:
+            state = votes.unlike_game(g.user.id, game_id)
+    except IntegrityError:
+        db.session.rollback()
+        state = None
+
+    if state is None or state.like_count is None:
+        return jsonify(error='game not found'), 404
+
+    return jsonify(game_id=game_id, liked=state.liked, changed=state.changed, like_count=state.like_count)
+
+@app.route('/api/games/<int:game_id>/tags/<int:tag_id>/vote', methods=['POST'])
+def api_tag_vote(game_id, tag_id):
+    """toggles the user's vote for a tag on a game"""
+
+    if not g.user:
+        return jsonify(error='unauthorized'), 401
+
+    try:
+        state = votes.toggle_tag_vote(g.user.id, game_id, tag_id)
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify(error='game or tag not found'), 404
+
+    return jsonify(game_id=game_id, tag_id=tag_id, voted=state.voted, vote_count=state.vote_count)
+
+
 ####################################################################
 ### Tag Routes ####
 
 @app.route('/tags')
 def show_tags():
     if g.user:
-        tags = Tag.query.all()
+        tags = tag_catalog.get_tags()
         return render_template('tags/tags.html', tags=tags)
 
     flash('access unauthorized', 'danger')   
@@ -584,6 +910,7 @@ def add_tag():
             tag = Tag(name=name)
 
             db.session.add(tag)
+            tag_catalog.bump_version()
             db.session.commit()
 
 
@@ -591,119 +918,133 @@ def add_tag():
             return redirect('/tags')
 
 
-@app.route("/games/game/<game_id>/tag", methods=['POST'])
-def tag_game(game_id):
+def vote_on_tag(game_id, tag_id):
+    """toggles the user's vote for a tag on a game and returns to the page"""
 
-    if g.user:
-        print('TAGGING')
-        tag_id = int(request.form.get('tags'))
-        user_id = g.user.id
-        game_tag = GameTag.query.filter(GameTag.tag_id == tag_id and GameTag.game_id == game_id).first()
-
-        if game_tag not in GameTag.query.filter(GameTag.game_id == game_id).all():
-            
-            try:
-                game_tag = GameTag(game_id = game_id, tag_id=tag_id)
-                db.session.add(game_tag)
-                db.session.commit()
-
-            except IntegrityError:
-             
-                db.session.rollback()
-                game_tag = GameTag.query.filter_by(game_id = game_id, tag_id=tag_id).first()
-                gtl = GameTagLikes.query.filter_by(game_tag_id = game_tag.id, user_id = g.user.id).first()
-                if gtl in GameTagLikes.query.all():
-                    gtl.delete()
-                    db.session.commit()
+    if not g.user:
+        flash('access unauthorized')
+        return redirect('/')
 
-        
-                    flash('tag like removed')
-                    return redirect(request.referrer)
-
-                else:  
-                    gtl = GameTagLikes(game_tag_id=game_tag.id, user_id=g.user.id)
-                    db.session.add(gtl)
-                    db.session.commit()
-                    flash('tag created and upvoted')
-                    return redirect (request.referrer)
-            
-        game_tag_like = GameTagLikes.query.filter_by(game_tag_id=game_tag.id, user_id=user_id).first()
-        if not game_tag_like:
-            game_tag_like = GameTagLikes(game_tag_id = game_tag.id, user_id = user_id)
-            db.session.add(game_tag_like)
-            db.session.commit()
+    if tag_id is None:
+        flash('pick a tag first')
+        return redirect(request.referrer)
 
-            flash('tag upvoted')
-            return redirect (request.referrer)
+    try:
+        state = votes.toggle_tag_vote(g.user.id, game_id, tag_id)
+    except IntegrityError:
+        # unknown game or tag
+        db.session.rollback()
+        abort(404)
 
-        if int(game_tag_like.user_id) == int(g.user.id):
-            db.session.delete(game_tag_like)
-            db.session.commit()
+    if state.voted:
+        flash('tag upvoted')
+    else:
+        flash('tag upvote removed')
+    return redirect(request.referrer)
 
-            flash('tag upvote removed')
-            return redirect(request.referrer)
-        
-        else:
-            flash('nothing happened?')
-            return redirect(request.referrer)
-    if not g.user.id:
-        flash('access unauthorized')
-        return redirect(request.referrer)
+@app.route("/games/game/<int:game_id>/tag", methods=['POST'])
+def tag_game(game_id):
+    """vote on the tag picked in a game card's tag dropdown"""
 
-@app.route("/games/game/<game_id>/tag/<tag_id>", methods=['POST'])
+    return vote_on_tag(game_id, request.form.get('tags', type=int))
+
+@app.route("/games/game/<int:game_id>/tag/<int:tag_id>", methods=['POST'])
 def tag_game_with_tag_button(game_id, tag_id):
+    """vote on a tag from its button"""
 
-    if g.user:
-        print('TAGGING')
-        tag_id = int(tag_id)
-        user_id = g.user.id
-        game_tag = GameTag.query.filter(GameTag.tag_id == tag_id and GameTag.game_id == game_id).first()
-
-        if game_tag not in GameTag.query.filter(GameTag.game_id == game_id).all():
-          
-            game_tag = GameTag(game_id = game_id, tag_id=tag_id)
-            db.session.add(game_tag)
-            db.session.commit()
-            game_tag_like = GameTagLikes(game_tag_id=game_tag.id, user_id = user_id)
-            db.session.add(game_tag_like)
-            db.session.commit()
+    return vote_on_tag(game_id, tag_id)
 
-            flash('tag created and upvoted')
-            return redirect (request.referrer)
+@app.route('/games/search')
+def search_games():
+    """feed of games filtered on their pgn headers.
 
-        game_tag_like = GameTagLikes.query.filter_by(game_tag_id=game_tag.id, user_id=user_id).first()
-     
-        if not game_tag_like:
-            game_tag_like = GameTagLikes(game_tag_id = game_tag.id, user_id = user_id)
-            db.session.add(game_tag_like)
-            db.session.commit()
+    takes ?player=, ?result= (1-0, 0-1 or 1/2-1/2), ?eco= (a code or prefix),
+    ?opening= (a name or its start) and ?min_elo= / ?max_elo=
+    """
 
-            flash('tag upvoted')
-            return redirect (request.referrer)
-        
-        if int(game_tag_like.user_id) == int(g.user.id):
-            db.session.delete(game_tag_like)
-            db.session.commit()
+    query = feed.filtered_games(player=request.args.get('player') or None,
+                                result=request.args.get('result') or None,
+                                eco=request.args.get('eco') or None,
+                                opening=request.args.get('opening') or None,
+                                min_elo=request.args.get('min_elo', type=int),
+                                max_elo=request.args.get('max_elo', type=int))
+    return render_feed('posted', query=query)
+
+@app.route('/games/position')
+def search_position():
+    """feed of games that reached the position given as ?fen="""
+
+    try:
+        position_hash = pgn_tools.position_hash(request.args.get('fen', '').strip())
+    except ValueError:
+        flash('that FEN is not a valid position', 'danger')
+        return redirect('/')
 
-            flash('tag upvote removed')
-            return redirect(request.referrer)
-        else:
-            flash('nothing happened?')
-            return redirect(request.referrer)
-    if not g.user.id:
-        flash('access unauthorized')
-        return redirect(request.referrer)
+    return render_feed('posted', query=feed.position_games(position_hash))
+
+@app.route('/explorer')
+def show_explorer():
+    """moves played from ?fen= (the starting position by default) across
+    every posted game"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    try:
+        board = chess.Board(request.args.get('fen') or chess.STARTING_FEN)
+    except ValueError:
+        flash('that FEN is not a valid position', 'danger')
+        return redirect('/explorer')
+
+    moves = []
+    for move in explorer.next_moves(pgn_tools.signed_zobrist(board)):
+        board.push_san(move.move)
+        moves.append((move, board.fen()))
+        board.pop()
+
+    return render_template('explorer.html', user=g.user, fen=board.fen(), moves=moves)
 
 @app.route('/games/search_by_tag')
 def search_by_tag():
-    tag_id = request.args['tag_id']
-    games = []
-    tags = Tag.query.all()
-    for game in Game.query.all():
-  
-        for item in game.game_tags:
-            if int(tag_id) == item.tags.id:
-                games.append(game)
-                break
-    return render_template('home.html', user=g.user, games=games, likes=g.user.likes, tags=tags)
+    """feed of games carrying the chosen tags.
+
+    ?tag_id= may repeat; ?mode=all requires every tag instead of any of them,
+    ?exclude= (may repeat) drops games with that tag, and ?min_votes= only
+    counts tags with at least that many votes.
+    """
+
+    query = tag_search_query()
+    if query is None:
+        flash('pick at least one tag to search by')
+        return redirect('/tags')
+
+    return render_feed('posted', query=query,
+                       export_urls=export_urls('export_tag_search', **request.args.to_dict(flat=False)))
+
+@app.route('/games/search_by_tag/export.<fmt>')
+def export_tag_search(fmt):
+    """the games from a tag search as one .pgn or .ndjson file"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    query = tag_search_query()
+    if query is None:
+        abort(404)
+
+    return export_response(query, fmt, 'tag-search')
+
+def tag_search_query():
+    """feed.tagged_games for the tag search args, or None without a tag"""
+
+    tag_ids = request.args.getlist('tag_id', type=int)
+    if not tag_ids:
+        return None
+
+    mode = 'all' if request.args.get('mode') == 'all' else 'any'
+    exclude = request.args.getlist('exclude', type=int)
+    min_votes = request.args.get('min_votes', 0, type=int)
 
+    return feed.tagged_games(tag_ids, mode=mode, exclude=exclude, min_votes=min_votes)
@@ -0,0 +1,274 @@
+"""Bulk PGN writes for Chess Byte: multi-game uploads and backfills.
+
+An uploaded .pgn file is spooled into upload_chunks by the web request and
+imported by the job worker, which reads it back line by line through
+pgn_tools.split_games, so only the current batch of games is ever in memory. Each batch is parsed on
+a process pool, then stored in one transaction: a multi-row insert into
+games that skips the user's duplicates, the new games' positions in
+multi-row inserts, and their explorer counts in one statement.
+
+backfill_pgns reparses stored games the same way, a batch at a time.
+"""
+
+import codecs
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+import explorer
+import pgn_tools
+from models import db, User, Game, GamePosition, UploadChunk
+
+games = Game.__table__
+game_positions = GamePosition.__table__
+upload_chunks = UploadChunk.__table__
+
+# Postgres allows 65535 bind parameters per statement, game_positions rows take 4
+POSITION_ROWS_PER_INSERT = 10000
+
+# past this many, failed games are counted but not listed
+MAX_REPORTED_ERRORS = 200
+
+# bytes of an upload per upload_chunks row
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class UploadReport:
+    """what happened to each game of an upload"""
+
+    def __init__(self):
+        self.added = 0
+        self.duplicates = 0
+        self.error_count = 0
+        # (game number in the file, message)
+        self.errors = []
+
+    def error(self, number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((number, message))
+
+    def to_dict(self):
+        return {
+            'added': self.added,
+            'duplicates': self.duplicates,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+
+def spool_upload(job_id, stream):
+    """copies an uploaded file into upload_chunks for its job, a chunk at a
+    time, in the caller's transaction"""
+
+    while True:
+        data = stream.read(UPLOAD_CHUNK_BYTES)
+        if not data:
+            return
+        db.session.execute(upload_chunks.insert().values(job_id=job_id, data=data))
+
+
+def spooled_lines(job_id, progress=None):
+    """yields the text lines of a spooled upload, loading one chunk at a
+    time; progress(chunks read, chunks) is called after each"""
+
+    chunk_ids = [chunk_id for chunk_id, in (db.session.query(UploadChunk.id)
+                                            .filter(UploadChunk.job_id == job_id)
+                                            .order_by(UploadChunk.id))]
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial = ''
+
+    for done, chunk_id in enumerate(chunk_ids, 1):
+        data = db.session.query(UploadChunk.data).filter(UploadChunk.id == chunk_id).scalar()
+        # a chunk can end mid line (or mid character); the rest comes with the next
+        *lines, partial = (partial + decoder.decode(data)).split('\n')
+        for line in lines:
+            yield line + '\n'
+        if progress:
+            progress(done, len(chunk_ids))
+
+    partial += decoder.decode(b'', final=True)
+    if partial:
+        yield partial
+
+
+def discard_upload(job_id):
+    """deletes a spooled upload and commits"""
+
+    db.session.execute(upload_chunks.delete().where(upload_chunks.c.job_id == job_id))
+    db.session.commit()
+
+
+def game_title(summary, number):
+    """'White vs Black' from the headers, or the game's place in the file"""
+
+    if summary.white and summary.black:
+        return f'{summary.white} vs {summary.black}'
+    return f'Uploaded game {number}'
+
+
+def _insert_batch(user_id, username, batch, report):
+    """stores one batch of (number, pgn, summary) and commits"""
+
+    now = datetime.utcnow()
+    rows = []
+    for number, pgn, summary in batch:
+        row = summary._asdict()
+        del row['positions']
+        row.update(user_id=user_id, username=username, title=game_title(summary, number), pgn=pgn, timestamp=now)
+        rows.append(row)
+
+    stmt = (insert(games)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=[games.c.user_id, games.c.pgn_hash])
+            .returning(games.c.id, games.c.pgn_hash))
+    game_ids = dict((pgn_hash, game_id) for game_id, pgn_hash in db.session.execute(stmt))
+
+    position_rows = []
+    for number, pgn, summary in batch:
+        game_id = game_ids.pop(summary.pgn_hash, None)
+        if game_id is None:
+            # already posted by this user, or earlier in the same file
+            report.duplicates += 1
+            continue
+
+        report.added += 1
+        position_rows.extend(_position_rows(game_id, summary))
+
+    _insert_positions(position_rows)
+    explorer.add_games(list({row['game_id'] for row in position_rows}))
+    db.session.commit()
+
+
+def _position_rows(game_id, summary):
+    return [{'game_id': game_id, 'ply': ply, 'hash': key, 'move': move}
+            for ply, (key, move) in enumerate(summary.positions)]
+
+
+def _insert_positions(position_rows):
+    for start in range(0, len(position_rows), POSITION_ROWS_PER_INSERT):
+        db.session.execute(game_positions.insert().values(position_rows[start:start + POSITION_ROWS_PER_INSERT]))
+
+
+def import_pgn(user_id, lines, batch_size=200, processes=None):
+    """posts every game in a multi-game PGN, read from an iterable of text
+    lines, for a user; returns an UploadReport.
+
+    Each batch is parsed on a pgn_tools.Summarizer pool of `processes`
+    workers (one per core by default) before it is stored.
+    """
+
+    report = UploadReport()
+    username = db.session.query(User.username).filter(User.id == user_id).scalar()
+
+    with pgn_tools.Summarizer(processes) as summarizer:
+        for batch in _batches(enumerate(pgn_tools.split_games(lines), 1), batch_size):
+            parsed = []
+            results = summarizer.map([pgn for _, pgn in batch])
+
+            for (number, pgn), (summary, error) in zip(batch, results):
+                if error:
+                    report.error(number, error)
+                else:
+                    parsed.append((number, pgn, summary))
+
+            if parsed:
+                _insert_batch(user_id, username, parsed, report)
+
+    return report
+
+
+def _batches(items, size):
+    """lists of up to `size` items, read lazily from `items`"""
+
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _stored_hashes(keys):
+    """the (user_id, pgn_hash) pairs among `keys` that a game already has;
+    one lookup on the duplicate index"""
+
+    keys = set(keys)
+    if not keys:
+        return set()
+    return set(db.session.query(Game.user_id, Game.pgn_hash)
+               .filter(tuple_(Game.user_id, Game.pgn_hash).in_(keys)))
+
+
+# the games columns a PGNSummary fills, set by backfill_pgns
+SUMMARY_COLUMNS = [field for field in pgn_tools.PGNSummary._fields if field != 'positions']
+
+
+def backfill_pgns(batch_size=500, everything=False, processes=None):
+    """fills pgn_hash, the header columns, the move list and game_positions
+    for games saved before they existed, or for every game with everything=True,
+    committing every `batch_size` games.
+
+    The pgns are parsed on a pgn_tools.Summarizer pool of `processes`
+    workers and written back with bulk statements, with the explorer counts
+    moved to the new positions in the same transaction. A later copy of a game
+    its user already has gets its header columns but keeps a null hash;
+    each batch looks its own hashes up rather than loading every stored one.
+    Returns (games updated, duplicate ids, unreadable ids).
+    """
+
+    updated, duplicates, unreadable = 0, [], []
+    last_id = 0
+
+    query = db.session.query(Game.id, Game.user_id, Game.pgn, Game.pgn_hash)
+    if not everything:
+        query = query.filter(db.or_(Game.pgn_hash.is_(None), Game.ply_count.is_(None), Game.moves.is_(None),
+                                    ~Game.positions.any()))
+
+    set_summary = (games.update()
+                   .where(games.c.id == db.bindparam('game_id'))
+                   .values({column: db.bindparam('new_' + column) for column in SUMMARY_COLUMNS}))
+
+    with pgn_tools.Summarizer(processes) as summarizer:
+        while True:
+            batch = query.filter(Game.id > last_id).order_by(Game.id).limit(batch_size).all()
+            if not batch:
+                return updated, duplicates, unreadable
+
+            results = summarizer.map([game.pgn for game in batch])
+            params, position_rows = [], []
+            seen = _stored_hashes((game.user_id, summary.pgn_hash)
+                                  for game, (summary, error) in zip(batch, results)
+                                  if not error and game.pgn_hash is None)
+
+            for game, (summary, error) in zip(batch, results):
+                if error:
+                    unreadable.append(game.id)
+                    continue
+
+                key = (game.user_id, summary.pgn_hash)
+                if game.pgn_hash is None and key in seen:
+                    duplicates.append(game.id)
+                    summary = summary._replace(pgn_hash=None)
+                seen.add(key)
+
+                row = {'new_' + column: getattr(summary, column) for column in SUMMARY_COLUMNS}
+                row['game_id'] = game.id
+                params.append(row)
+                position_rows.extend(_position_rows(game.id, summary))
+
+            if params:
+                game_ids = [row['game_id'] for row in params]
+                # out of the explorer under the old positions and result,
+                # back in under the new ones
+                explorer.remove_games(game_ids)
+                db.session.execute(set_summary, params)
+                db.session.execute(game_positions.delete().where(game_positions.c.game_id.in_(game_ids)))
+                _insert_positions(position_rows)
+                explorer.add_games(game_ids)
+
+            updated += len(params)
+            last_id = batch[-1].id
+            db.session.commit()
@@ -0,0 +1,370 @@
+"""Client for the chess.com published-data API.
+
+https://www.chess.com/news/view/published-data-api#pubapi-endpoint-games
+
+One pooled requests.Session per worker, and an on-disk cache of monthly
+archives keyed by (username, year, month). A month that had already ended
+when it was fetched can't change any more, so it is served from disk with no
+request at all; the current month is revalidated with ETag / Last-Modified
+and only re-downloaded when chess.com says it changed.
+
+A player's whole history is fetched month by month on a thread pool no
+wider than the connection pool, and stored in chesscom_games as each month
+arrives.
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from itertools import islice
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from sqlalchemy.dialects.postgresql import insert
+from urllib3.util.retry import Retry
+
+from models import db, ArchivedGame
+
+BASE_URL = 'https://api.chess.com/pub/player'
+USER_AGENT = 'ChessByte (+https://github.com/orenpaley/chessbyte)'
+
+# what chess.com allows in a username; anything else could walk out of the
+# cache directory or into another API path
+USERNAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class ChessComError(Exception):
+    """chess.com couldn't give us the archive asked for"""
+
+
+def clean_username(username):
+    """the lowercased username, raising ValueError unless it's a valid
+    chess.com username"""
+
+    username = (username or '').strip().lower()
+    if not USERNAME.match(username):
+        raise ValueError(f'not a chess.com username: {username!r}')
+    return username
+
+
+def month_is_over(year, month, now=None):
+    """True once every game of (year, month) has finished being played"""
+
+    now = now or datetime.utcnow()
+    return (year, month) < (now.year, now.month)
+
+
+# chess.com per-side result codes that mean the game was drawn; every other
+# code on the losing side (checkmated, resigned, timeout, ...) is a loss
+DRAW_RESULTS = {'agreed', 'repetition', 'stalemate', 'insufficient', '50move', 'timevsinsufficient'}
+
+
+def player_color(game, username):
+    """'white' or 'black' for the side `username` played in an archive game"""
+
+    if game['white']['username'].lower() == username.lower():
+        return 'white'
+    if game['black']['username'].lower() == username.lower():
+        return 'black'
+    return None
+
+
+def player_result(game, color):
+    """'win', 'loss' or 'draw' from the point of view of `color`"""
+
+    code = game[color]['result']
+    if code == 'win':
+        return 'win'
+    if code in DRAW_RESULTS:
+        return 'draw'
+    return 'loss'
+
+
+def filter_games(games, username, time_class=None, color=None, result=None,
+                 min_opponent_rating=None, max_opponent_rating=None):
+    """lazily yields the archive games matching every filter that is set"""
+
+    for game in games:
+        if time_class and game.get('time_class') != time_class:
+            continue
+
+        side = player_color(game, username)
+        if side is None or (color and side != color):
+            continue
+
+        if result and player_result(game, side) != result:
+            continue
+
+        opponent = 'black' if side == 'white' else 'white'
+        rating = game[opponent].get('rating') or 0
+        if min_opponent_rating is not None and rating < min_opponent_rating:
+            continue
+        if max_opponent_rating is not None and rating > max_opponent_rating:
+            continue
+
+        yield game
+
+
+def archive_window(games, username, offset=0, limit=10, **filters):
+    """the `limit` matching games after skipping `offset` of them; nothing
+    past the window is filtered or copied"""
+
+    return list(islice(filter_games(games, username, **filters), offset, offset + limit))
+
+
+class ChessComClient:
+    """pooled, cached access to a player's monthly game archives"""
+
+    def __init__(self, cache_dir, timeout=10, pool_size=10):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        # pool_block caps open connections to api.chess.com at pool_size,
+        # however many threads are fetching
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.session.mount('https://', adapter)
+
+    def _cache_path(self, username, year, month):
+        return os.path.join(self.cache_dir, clean_username(username), f'{year:04d}-{month:02d}.json')
+
+    def _read_cache(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, path, entry):
+        """writes through a temp file so readers never see half an archive"""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def get(self, url, **kwargs):
+        """GET through the pooled session with the client's timeout"""
+
+        try:
+            return self.session.get(url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as exc:
+            raise ChessComError(f'could not reach chess.com: {exc}')
+
+    def cached_archive(self, username, year, month):
+        """a finished month's games straight from disk, or None if it isn't
+        cached yet; never touches the network"""
+
+        cached = self._read_cache(self._cache_path(username, year, month))
+        if cached and cached['complete']:
+            return cached['games']
+        return None
+
+    def monthly_archive(self, username, year, month):
+        """the list of game dicts chess.com has for a player in one month;
+        raises ValueError for an invalid username"""
+
+        username = clean_username(username)
+        path = self._cache_path(username, year, month)
+        cached = self._read_cache(path)
+
+        if cached and cached['complete']:
+            return cached['games']
+
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        complete = month_is_over(year, month)
+        resp = self.get(f'{BASE_URL}/{username}/games/{year}/{month:02d}', headers=headers)
+
+        if resp.status_code == 304 and cached:
+            if complete:
+                cached['complete'] = True
+                self._write_cache(path, cached)
+            return cached['games']
+
+        if resp.status_code == 404:
+            raise ChessComError(f'no chess.com archive for {username} in {year}/{month:02d}')
+        if resp.status_code != 200:
+            raise ChessComError(f'chess.com answered {resp.status_code}')
+
+        games = resp.json().get('games', [])
+        self._write_cache(path, {
+            'complete': complete,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'games': games,
+        })
+        return games
+
+    def archive_months(self, username):
+        """every (year, month) chess.com has an archive for, oldest first;
+        raises ValueError for an invalid username"""
+
+        username = clean_username(username)
+        resp = self.get(f'{BASE_URL}/{username}/games/archives')
+
+        if resp.status_code == 404:
+            raise ChessComError(f'no chess.com player named {username}')
+        if resp.status_code != 200:
+            raise ChessComError(f'chess.com answered {resp.status_code}')
+
+        months = []
+        for url in resp.json().get('archives', []):
+            year, month = url.rstrip('/').split('/')[-2:]
+            months.append((int(year), int(month)))
+        return sorted(months)
+
+    def fetch_history(self, username, months=None):
+        """fetches every monthly archive (or just `months`) concurrently.
+
+        Yields (year, month, games, error) as each month finishes, in
+        completion order; error is a ChessComError or None.
+        """
+
+        if months is None:
+            months = self.archive_months(username)
+
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            futures = {pool.submit(self.monthly_archive, username, year, month): (year, month)
+                       for year, month in months}
+
+            for future in as_completed(futures):
+                year, month = futures[future]
+                try:
+                    yield year, month, future.result(), None
+                except ChessComError as exc:
+                    yield year, month, [], exc
+
+
+def _archived_row(username, game):
+    """chesscom_games column values for one archive game, or None when it
+    has nothing to import"""
+
+    color = player_color(game, username)
+    if color is None or not game.get('pgn') or not game.get('uuid'):
+        return None
+
+    opponent = 'black' if color == 'white' else 'white'
+    end_time = game.get('end_time')
+
+    return {
+        'username': username,
+        'uuid': game['uuid'],
+        'url': game.get('url'),
+        'end_time': datetime.utcfromtimestamp(end_time) if end_time else None,
+        'time_class': game.get('time_class'),
+        'color': color,
+        'result': player_result(game, color),
+        'opponent_rating': game[opponent].get('rating'),
+        'white_username': game['white']['username'],
+        'white_rating': game['white'].get('rating'),
+        'black_username': game['black']['username'],
+        'black_rating': game['black'].get('rating'),
+        'pgn': game['pgn'],
+    }
+
+
+def store_games(username, games):
+    """saves archive games to chesscom_games in one statement, skipping ones
+    already stored for this player; commits and returns how many were new"""
+
+    username = username.strip().lower()
+    rows = [row for row in (_archived_row(username, game) for game in games) if row]
+    if not rows:
+        return 0
+
+    table = ArchivedGame.__table__
+    stmt = (insert(table)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=[table.c.username, table.c.uuid])
+            .returning(table.c.id))
+    added = len(db.session.execute(stmt).fetchall())
+    db.session.commit()
+    return added
+
+
+def import_history(username, months=None, progress=None):
+    """fetches a player's whole archive (or just `months`) into
+    chesscom_games, storing each month as soon as it arrives.
+
+    progress(done, total) is called before the first month and after each
+    one. Returns (games added, months that failed).
+    """
+
+    client = get_client()
+    if months is None:
+        months = client.archive_months(username)
+
+    if progress:
+        progress(0, len(months))
+
+    added = 0
+    failed = []
+    for done, (year, month, games, error) in enumerate(client.fetch_history(username, months), 1):
+        if error:
+            failed.append((year, month))
+        else:
+            added += store_games(username, games)
+
+        if progress:
+            progress(done, len(months))
+
+    return added, sorted(failed)
+
+
+def stored_games(username, year=None, month=None, time_class=None, color=None, result=None,
+                 min_opponent_rating=None, max_opponent_rating=None):
+    """query for a player's stored games, newest first, with the same
+    filters as filter_games applied in SQL, optionally for one month"""
+
+    query = ArchivedGame.query.filter(ArchivedGame.username == username.strip().lower())
+
+    if year and month:
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        query = query.filter(ArchivedGame.end_time >= start, ArchivedGame.end_time < end)
+
+    if time_class:
+        query = query.filter(ArchivedGame.time_class == time_class)
+    if color:
+        query = query.filter(ArchivedGame.color == color)
+    if result:
+        query = query.filter(ArchivedGame.result == result)
+    if min_opponent_rating is not None:
+        query = query.filter(ArchivedGame.opponent_rating >= min_opponent_rating)
+    if max_opponent_rating is not None:
+        query = query.filter(ArchivedGame.opponent_rating <= max_opponent_rating)
+
+    return query.order_by(ArchivedGame.end_time.desc(), ArchivedGame.id.desc())
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """this worker's ChessComClient, built from the app config on first use"""
+
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            config = current_app.config
+            _client = ChessComClient(config['CHESSCOM_CACHE_DIR'],
+                                     timeout=config['CHESSCOM_TIMEOUT'],
+                                     pool_size=config['CHESSCOM_MAX_CONNECTIONS'])
+        return _client
@@ -0,0 +1,82 @@
+"""ECO opening classification for Chess Byte.
+
+The opening lines in data/eco.tsv are loaded once into a trie keyed by SAN
+move, and a game is classified by the deepest line its moves follow, so a
+lookup costs one dict step per move of the longest line and never parses a
+board.
+"""
+
+import csv
+import os
+from collections import namedtuple
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'eco.tsv')
+
+Opening = namedtuple('Opening', ['eco', 'name'])
+
+
+class _Node:
+    __slots__ = ('children', 'opening')
+
+    def __init__(self):
+        self.children = {}
+        self.opening = None
+
+
+def _moves(movetext):
+    """the SAN moves of '1. e4 e5 2. Nf3', without the move numbers"""
+
+    return [token for token in movetext.split() if not token[0].isdigit()]
+
+
+def build_trie(path=DATA_FILE):
+    """reads an eco, name, pgn tsv into a trie; returns (root, depth of the
+    longest line)"""
+
+    root = _Node()
+    depth = 0
+
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            moves = _moves(row['pgn'])
+            node = root
+            for move in moves:
+                node = node.children.setdefault(move, _Node())
+            node.opening = Opening(row['eco'], row['name'])
+            depth = max(depth, len(moves))
+
+    return root, depth
+
+
+_trie = None
+
+
+def _get_trie():
+    global _trie
+
+    if _trie is None:
+        _trie = build_trie()
+    return _trie
+
+
+def max_depth():
+    """how many moves of a game classify() can look at"""
+
+    return _get_trie()[1]
+
+
+def classify(moves):
+    """the Opening of the longest line that `moves` (SAN, from the starting
+    position) begins with, or None"""
+
+    node = _get_trie()[0]
+    opening = None
+
+    for move in moves:
+        node = node.children.get(move)
+        if node is None:
+            break
+        if node.opening is not None:
+            opening = node.opening
+
+    return opening
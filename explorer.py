@@ -0,0 +1,134 @@
+"""Opening explorer for Chess Byte.
+
+explorer_moves holds, for every (position, move) pair played in a posted
+game, how many games played it and how they ended. It is kept up to date
+from game_positions one game at a time: remove_game() takes a game's
+contribution out before it is edited or deleted, add_game() puts it back
+once the new positions are flushed. Each is a single statement, and
+reading the moves from a position is one primary key range scan.
+
+Every game shares the opening rows, so both directions lock the rows they
+touch in (position_hash, move) order; concurrent uploads, edits and deletes
+then queue on the first shared row instead of deadlocking.
+"""
+
+from collections import namedtuple
+
+from models import db, ExplorerMove
+
+# a game counts once per (position, move), even if it repeats the position
+GAME_MOVES = """
+    SELECT DISTINCT p.game_id, p.hash AS position_hash, p.move,
+           CASE WHEN g.result = '1-0' THEN 1 ELSE 0 END AS white_wins,
+           CASE WHEN g.result = '1/2-1/2' THEN 1 ELSE 0 END AS draws,
+           CASE WHEN g.result = '0-1' THEN 1 ELSE 0 END AS black_wins
+    FROM game_positions p
+    JOIN games g ON g.id = p.game_id
+    WHERE p.move IS NOT NULL AND {where}
+"""
+
+ADD_MOVES = """
+    INSERT INTO explorer_moves (position_hash, move, games, white_wins, draws, black_wins)
+    SELECT position_hash, move, count(*), sum(white_wins), sum(draws), sum(black_wins)
+    FROM ({game_moves}) AS game_moves
+    GROUP BY position_hash, move
+    ORDER BY position_hash, move
+    ON CONFLICT (position_hash, move) DO UPDATE
+    SET games = explorer_moves.games + excluded.games,
+        white_wins = explorer_moves.white_wins + excluded.white_wins,
+        draws = explorer_moves.draws + excluded.draws,
+        black_wins = explorer_moves.black_wins + excluded.black_wins
+"""
+
+ADD_GAME = db.text(ADD_MOVES.format(game_moves=GAME_MOVES.format(where='p.game_id = :game_id')))
+ADD_GAMES = db.text(ADD_MOVES.format(game_moves=GAME_MOVES.format(where='p.game_id = ANY(:game_ids)')))
+ADD_ALL_GAMES = db.text(ADD_MOVES.format(game_moves=GAME_MOVES.format(where='TRUE')))
+
+REMOVE_MOVES = """
+    WITH locked AS (
+        SELECT e.position_hash, e.move, m.games, m.white_wins, m.draws, m.black_wins
+        FROM explorer_moves e
+        JOIN (
+            SELECT position_hash, move, count(*) AS games, sum(white_wins) AS white_wins,
+                   sum(draws) AS draws, sum(black_wins) AS black_wins
+            FROM ({game_moves}) AS game_moves
+            GROUP BY position_hash, move
+        ) AS m ON e.position_hash = m.position_hash AND e.move = m.move
+        ORDER BY e.position_hash, e.move
+        FOR UPDATE OF e
+    )
+    UPDATE explorer_moves e
+    SET games = e.games - m.games,
+        white_wins = e.white_wins - m.white_wins,
+        draws = e.draws - m.draws,
+        black_wins = e.black_wins - m.black_wins
+    FROM locked AS m
+    WHERE e.position_hash = m.position_hash AND e.move = m.move
+"""
+
+REMOVE_GAME = db.text(REMOVE_MOVES.format(game_moves=GAME_MOVES.format(where='p.game_id = :game_id')))
+REMOVE_GAMES = db.text(REMOVE_MOVES.format(game_moves=GAME_MOVES.format(where='p.game_id = ANY(:game_ids)')))
+
+
+def add_game(game_id):
+    """counts a game's saved positions into the explorer; the caller
+    flushes the positions first and commits after"""
+
+    db.session.execute(ADD_GAME, {'game_id': game_id})
+
+
+def add_games(game_ids):
+    """add_game for a batch of games in one statement"""
+
+    if game_ids:
+        db.session.execute(ADD_GAMES, {'game_ids': list(game_ids)})
+
+
+def remove_game(game_id):
+    """takes a game's saved positions back out of the explorer; call before
+    its positions are rewritten or deleted"""
+
+    db.session.execute(REMOVE_GAME, {'game_id': game_id})
+
+
+def remove_games(game_ids):
+    """remove_game for a batch of games in one statement"""
+
+    if game_ids:
+        db.session.execute(REMOVE_GAMES, {'game_ids': list(game_ids)})
+
+
+def rebuild():
+    """recounts the whole explorer from game_positions and commits"""
+
+    ExplorerMove.query.delete()
+    db.session.execute(ADD_ALL_GAMES)
+    db.session.commit()
+
+
+# one row of the explorer table; the percentages are of decided and drawn
+# games, so games without a result only show up in `games`
+NextMove = namedtuple('NextMove', ['move', 'games', 'white_pct', 'draw_pct', 'black_pct'])
+
+
+def _pct(part, whole):
+    return round(100 * part / whole) if whole else 0
+
+
+def next_moves(position_hash):
+    """the moves played from a position, most played first"""
+
+    rows = (ExplorerMove.query
+            .filter(ExplorerMove.position_hash == position_hash)
+            .filter(ExplorerMove.games > 0)
+            .order_by(ExplorerMove.games.desc(), ExplorerMove.move))
+
+    moves = []
+    for row in rows:
+        finished = row.white_wins + row.draws + row.black_wins
+        moves.append(NextMove(move=row.move,
+                              games=row.games,
+                              white_pct=_pct(row.white_wins, finished),
+                              draw_pct=_pct(row.draws, finished),
+                              black_pct=_pct(row.black_wins, finished)))
+    return moves
@@ -0,0 +1,85 @@
+"""Streaming game exports for Chess Byte.
+
+An export is a generator over a server-side cursor (yield_per turns on
+stream_results with psycopg2), so only one chunk of rows is in the worker
+at a time however many games match. Output is either one concatenated
+.pgn file or NDJSON, one game per line, optionally gzipped as it goes.
+"""
+
+import json
+import zlib
+from itertools import islice
+
+from models import User, Game
+
+# rows fetched from the cursor, and written to the response, at a time
+ROWS_PER_CHUNK = 500
+
+FORMATS = {
+    'pgn': 'application/x-chess-pgn',
+    'ndjson': 'application/x-ndjson',
+}
+
+EXPORT_COLUMNS = (Game.id, Game.title, Game.timestamp, User.username, Game.white, Game.black,
+                  Game.result, Game.eco, Game.opening, Game.date, Game.like_count, Game.pgn)
+
+
+def _pgn(row):
+    return row.pgn.strip() + '\n\n'
+
+
+def _ndjson(row):
+    return json.dumps({
+        'id': row.id,
+        'title': row.title,
+        'posted_at': row.timestamp.isoformat(),
+        'username': row.username,
+        'white': row.white,
+        'black': row.black,
+        'result': row.result,
+        'eco': row.eco,
+        'opening': row.opening,
+        'date': row.date.isoformat() if row.date else None,
+        'like_count': row.like_count,
+        'pgn': row.pgn,
+    }) + '\n'
+
+
+WRITERS = {'pgn': _pgn, 'ndjson': _ndjson}
+
+
+def _rows(query):
+    """the export columns for a Game query, oldest game first, streamed"""
+
+    return (query.with_entities(*EXPORT_COLUMNS)
+            .outerjoin(User, User.id == Game.user_id)
+            .order_by(Game.id)
+            .yield_per(ROWS_PER_CHUNK))
+
+
+def _chunks(query, fmt):
+    write = WRITERS[fmt]
+    rows = iter(_rows(query))
+    while True:
+        chunk = ''.join(write(row) for row in islice(rows, ROWS_PER_CHUNK))
+        if not chunk:
+            return
+        yield chunk.encode('utf-8')
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(query, fmt, compress=False):
+    """bytes of an export of the games in `query`, a Game query, as `fmt`
+    ('pgn' or 'ndjson'), gzipped if `compress`"""
+
+    chunks = _chunks(query, fmt)
+    return _gzipped(chunks) if compress else chunks
+
@@ -0,0 +1,273 @@
+"""Keyset-paginated home feed for Chess Byte.
+
+Every sort order is a SQL ORDER BY on (sort key, game id). A page is the
+next `per_page` rows strictly after the last row of the previous page, so
+the cursor stays stable while new games and likes come in, and deep pages
+cost the same as the first one.
+"""
+
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import func, or_, tuple_
+
+from models import db, Game, GamePosition, Like, Tag, GameTag
+
+
+# what home.html renders for each game card; built by load_cards() so the
+# template never touches a lazy relationship
+FeedGame = namedtuple('FeedGame', ['id', 'user_id', 'title', 'pgn', 'pgn_hash', 'username',
+                                   'like_count', 'tags'])
+FeedTag = namedtuple('FeedTag', ['id', 'name', 'votes'])
+
+
+class InvalidCursor(ValueError):
+    """raised when a page cursor can't be decoded"""
+
+
+class FeedSort:
+    """one feed ordering.
+
+    `key` takes the base query and returns (query, sort key expression),
+    joining whatever the key needs. `parse` turns a cursor's JSON key back
+    into a value of the key's type, raising ValueError for anything else.
+    """
+
+    def __init__(self, key, parse, descending=False):
+        self.key = key
+        self.parse = parse
+        self.descending = descending
+
+
+def _by_id(query):
+    return query, Game.id
+
+
+def _by_timestamp(query):
+    return query, Game.timestamp
+
+
+def _by_title(query):
+    return query, func.lower(Game.title)
+
+
+def _by_username(query):
+    return query, func.coalesce(Game.username, '')
+
+
+def _by_like_count(query):
+    return query, Game.like_count
+
+
+def _by_tag_count(query):
+    return query, Game.tag_count
+
+
+def _parse_int(value):
+    """an int that fits the 32 bit id and counter columns"""
+
+    if type(value) is not int or not -2 ** 31 <= value < 2 ** 31:
+        raise ValueError(value)
+    return value
+
+
+def _parse_str(value):
+    # Postgres text can't hold NUL
+    if not isinstance(value, str) or '\x00' in value:
+        raise ValueError(value)
+    return value
+
+
+def _parse_timestamp(value):
+    return datetime.strptime(_parse_str(value), '%Y-%m-%dT%H:%M:%S.%f')
+
+
+SORTS = {
+    # posting order by id alone, so filtered feeds can walk an index on game_id
+    'posted': FeedSort(_by_id, _parse_int, descending=True),
+    'newest': FeedSort(_by_timestamp, _parse_timestamp, descending=True),
+    'oldest': FeedSort(_by_timestamp, _parse_timestamp),
+    'user_a_z': FeedSort(_by_username, _parse_str),
+    'user_z_a': FeedSort(_by_username, _parse_str, descending=True),
+    'title_a_z': FeedSort(_by_title, _parse_str),
+    'title_z_a': FeedSort(_by_title, _parse_str, descending=True),
+    'most_likes': FeedSort(_by_like_count, _parse_int, descending=True),
+    'least_likes': FeedSort(_by_like_count, _parse_int),
+    'most_tags': FeedSort(_by_tag_count, _parse_int, descending=True),
+    'least_tags': FeedSort(_by_tag_count, _parse_int),
+}
+
+
+def encode_cursor(key, game_id):
+    """packs the last row's sort key and id into a url safe token"""
+
+    if isinstance(key, datetime):
+        key = key.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+    raw = json.dumps([key, game_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """unpacks a token from encode_cursor into (sort key, game id),
+    checking both fit the sort so a tampered cursor can't reach the query"""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key, game_id = json.loads(raw.decode('utf-8'))
+        return sort.parse(key), _parse_int(game_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def load_cards(games):
+    """builds FeedGame cards for `games` in a fixed number of queries.
+
+    Poster usernames and like counts live on the game row; tags with their
+    names and vote counts come from one more query, however many games
+    there are.
+    """
+
+    game_ids = [game.id for game in games]
+    if not game_ids:
+        return []
+
+    tags = {game_id: [] for game_id in game_ids}
+    tag_rows = (db.session.query(GameTag.game_id, Tag.id, Tag.name, GameTag.vote_count)
+                .join(Tag, Tag.id == GameTag.tag_id)
+                .filter(GameTag.game_id.in_(game_ids))
+                .order_by(GameTag.id))
+    for game_id, tag_id, name, votes in tag_rows:
+        tags[game_id].append(FeedTag(tag_id, name, votes))
+
+    return [FeedGame(id=game.id,
+                     user_id=game.user_id,
+                     title=game.title,
+                     pgn=game.pgn,
+                     pgn_hash=game.pgn_hash,
+                     username=game.username,
+                     like_count=game.like_count,
+                     tags=tags[game.id])
+            for game in games]
+
+
+def tagged_games(tag_ids, mode='any', exclude=(), min_votes=0):
+    """query for games carrying the given tags.
+
+    mode 'any' matches games with at least one of `tag_ids`, 'all' only games
+    with every one of them. Games carrying any `exclude` tag are dropped, and
+    a tag only counts once it has at least `min_votes` votes. Every branch is
+    a lookup on the game_tags (tag_id, game_id) index.
+    """
+
+    tag_ids = set(tag_ids)
+
+    matches = (db.session.query(GameTag.game_id)
+               .filter(GameTag.tag_id.in_(tag_ids))
+               .filter(GameTag.vote_count >= min_votes))
+    if mode == 'all':
+        matches = (matches.group_by(GameTag.game_id)
+                   .having(func.count(GameTag.tag_id) == len(tag_ids)))
+
+    query = db.session.query(Game).filter(Game.id.in_(matches.subquery()))
+
+    if exclude:
+        excluded = (db.session.query(GameTag.id)
+                    .filter(GameTag.game_id == Game.id)
+                    .filter(GameTag.tag_id.in_(set(exclude)))
+                    .filter(GameTag.vote_count >= min_votes))
+        query = query.filter(~excluded.exists())
+
+    return query
+
+
+def filtered_games(player=None, result=None, eco=None, opening=None, min_elo=None, max_elo=None):
+    """query for games matching the columns parsed from their pgn headers.
+
+    `player` matches either side, case insensitively; `eco` matches a code
+    prefix, so 'B' or 'B9' work too, and `opening` a name prefix, so
+    'Sicilian Defense' finds every Sicilian; min_elo / max_elo apply to both
+    players. Each filter has its own index on games.
+    """
+
+    query = db.session.query(Game)
+
+    if player:
+        player = player.strip().lower()
+        query = query.filter(or_(func.lower(Game.white) == player, func.lower(Game.black) == player))
+    if result:
+        query = query.filter(Game.result == result)
+    if eco:
+        query = query.filter(Game.eco.like(eco.strip().upper() + '%'))
+    if opening:
+        query = query.filter(Game.opening.like(opening.strip() + '%'))
+    if min_elo is not None:
+        query = query.filter(Game.white_elo >= min_elo, Game.black_elo >= min_elo)
+    if max_elo is not None:
+        query = query.filter(Game.white_elo <= max_elo, Game.black_elo <= max_elo)
+
+    return query
+
+
+def liked_games(user_id):
+    """query for the games a user liked"""
+
+    liked = db.session.query(Like.game_id).filter(Like.user_id == user_id)
+    return db.session.query(Game).filter(Game.id.in_(liked.subquery()))
+
+
+def liked_cards(user_id):
+    """FeedGame cards for every game a user liked, newest first, in the
+    same fixed number of queries as a feed page"""
+
+    games = liked_games(user_id).order_by(Game.timestamp.desc(), Game.id.desc())
+    return load_cards(games.all())
+
+
+def position_games(position_hash):
+    """query for games whose mainline reached the position with this
+    Zobrist hash, by any move order; one lookup on the game_positions
+    (hash, game_id) index"""
+
+    matches = db.session.query(GamePosition.game_id).filter(GamePosition.hash == position_hash)
+    return db.session.query(Game).filter(Game.id.in_(matches.subquery()))
+
+
+def page(sort_name, after=None, per_page=25, query=None):
+    """returns (cards, next_cursor) for one page of the feed.
+
+    `query` narrows the feed to a filtered Game query, e.g. from
+    tagged_games(). next_cursor is None on the last page.
+    """
+
+    if query is None:
+        query = db.session.query(Game)
+
+    sort = SORTS[sort_name]
+    query, key = sort.key(query)
+    query = query.add_columns(key)
+
+    if after:
+        last_key, last_id = decode_cursor(after, sort)
+        if sort.descending:
+            query = query.filter(tuple_(key, Game.id) < tuple_(last_key, last_id))
+        else:
+            query = query.filter(tuple_(key, Game.id) > tuple_(last_key, last_id))
+
+    if sort.descending:
+        query = query.order_by(key.desc(), Game.id.desc())
+    else:
+        query = query.order_by(key, Game.id)
+
+    rows = query.limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last_game, last_key = rows[-1]
+        next_cursor = encode_cursor(last_key, last_game.id)
+
+    return load_cards([game for game, _ in rows]), next_cursor
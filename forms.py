@@ -2,11 +2,14 @@
 import email
 from tokenize import String
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField, IntegerField, FieldList, FormField, SelectField, widgets, SelectMultipleField
+from flask_wtf.file import FileField, FileRequired, FileAllowed
+from wtforms import StringField, PasswordField, TextAreaField, IntegerField, FieldList, FormField, SelectField, widgets, SelectMultipleField, BooleanField, HiddenField
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
 
-from wtforms.validators import DataRequired, Email, Length, NumberRange
+from wtforms.validators import DataRequired, Email, Length, NumberRange, Optional, Regexp, ValidationError
 from models import Tag
+import pgn_tools
+import chesscom
 
 class RegisterForm(FlaskForm):
     """Form for adding users."""
@@ -33,17 +36,44 @@ class PostGameForm(FlaskForm):
   title = StringField('Title', validators=[DataRequired()])
   pgn = TextAreaField('Copy your PGN text here', validators=[DataRequired()])
 
+  # the parsed pgn, kept for Game.set_pgn so it is only read once
+  summary = None
+
+  def validate_pgn(self, field):
+    try:
+      self.summary = pgn_tools.summarize(field.data)
+    except pgn_tools.InvalidPGN as exc:
+      raise ValidationError(str(exc))
+
+class UploadPGNForm(FlaskForm):
+  """form to upload a .pgn file holding any number of games"""
+  pgn = FileField('PGN file', validators=[FileRequired(), FileAllowed(['pgn'], 'upload a .pgn file')])
+
+class ImportGameForm(FlaskForm):
+  """form to post a game picked from chess.com search results; the pgn is
+  looked up on the server from username + uuid"""
+  title = StringField('Title', validators=[DataRequired()])
+  username = HiddenField(validators=[DataRequired()])
+  uuid = HiddenField(validators=[DataRequired()])
+
 class TagForm(FlaskForm):
   """form to add tags to global tags list"""
   name = StringField('Tag Name', validators=[DataRequired(), Length(max=50)])
 
 class SearchGamesForm(FlaskForm):
   """Form to search chesscom users"""
-  username = StringField('chess.com username', validators=[DataRequired()])
-  year = IntegerField(validators=[NumberRange(min=1990,max=2022)])
-  month = IntegerField(validators=[NumberRange(min=1, max=12)])
+  username = StringField('chess.com username', filters=[lambda value: value.strip() if value else value],
+                         validators=[DataRequired(), Regexp(chesscom.USERNAME, message='letters, digits, _ and - only')])
+  whole_history = BooleanField('Search the whole history (ignores year and month)')
+  year = IntegerField(validators=[Optional(), NumberRange(min=1990,max=2022)])
+  month = IntegerField(validators=[Optional(), NumberRange(min=1, max=12)])
   offset = IntegerField(validators=[NumberRange(min=0, max=9999)])
   limit = IntegerField(validators=[NumberRange(min=1, max=50)])
+  time_class = SelectField('Time Control', choices=[('', 'any time control'), ('bullet', 'bullet'), ('blitz', 'blitz'), ('rapid', 'rapid'), ('daily', 'daily')], default='')
+  color = SelectField('Color', choices=[('', 'either color'), ('white', 'as white'), ('black', 'as black')], default='')
+  result = SelectField('Result', choices=[('', 'any result'), ('win', 'wins'), ('loss', 'losses'), ('draw', 'draws')], default='')
+  min_opponent_rating = IntegerField('(Optional) min opponent rating', validators=[Optional(), NumberRange(min=0, max=4000)])
+  max_opponent_rating = IntegerField('(Optional) max opponent rating', validators=[Optional(), NumberRange(min=0, max=4000)])
 
 class UserProfileForm(FlaskForm):
   """class to edit user profile info"""
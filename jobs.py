@@ -0,0 +1,162 @@
+"""Background import jobs for Chess Byte.
+
+Web requests only insert a row into import_jobs and return; a separate
+worker process (`flask import-worker`, see the Procfile) claims queued jobs
+with SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers can run
+side by side, and reports progress back onto the job row for the status
+endpoint to read. A running job whose heartbeat (updated_at) goes stale is
+assumed to have lost its worker and is picked up again.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, or_
+
+import bulk
+import chesscom
+from models import db, ImportJob
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """registers the function that runs jobs of `kind`.
+
+    It is called with the job and a progress(done, total) callback, and
+    returns a short message for the finished job.
+    """
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, params, user_id=None, result_url=None, attach=None):
+    """queues a job and returns it; the caller's transaction is committed.
+
+    attach(job), if given, runs once the job has an id and before the
+    commit, to store whatever the job reads, so no worker can claim the
+    job before that is there.
+    """
+
+    if kind not in HANDLERS:
+        raise ValueError(f'unknown job kind {kind!r}')
+
+    job = ImportJob(kind=kind, params=params, user_id=user_id, result_url=result_url)
+    db.session.add(job)
+    if attach is not None:
+        db.session.flush()
+        attach(job)
+    db.session.commit()
+    return job
+
+
+def claim_next(stale_after):
+    """marks the oldest runnable job as running and returns it, or None"""
+
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=stale_after)
+
+    job = (ImportJob.query
+           .filter(or_(ImportJob.status == 'queued',
+                       and_(ImportJob.status == 'running', ImportJob.updated_at < stale)))
+           .order_by(ImportJob.id)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.attempts += 1
+    job.updated_at = now
+    db.session.commit()
+    return job
+
+
+def run(job):
+    """runs one claimed job to completion, recording done or failed"""
+
+    def progress(done, total):
+        job.progress = done
+        job.total = total
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    try:
+        message = HANDLERS[job.kind](job, progress)
+    except Exception as exc:
+        db.session.rollback()
+        job.status = 'failed'
+        job.message = str(exc) or exc.__class__.__name__
+    else:
+        job.status = 'done'
+        job.message = message
+
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def work(poll_interval=1.0, stale_after=300, once=False):
+    """claims and runs jobs until interrupted; with once=True, stops when
+    the queue is empty"""
+
+    while True:
+        job = claim_next(stale_after)
+        if job is not None:
+            run(job)
+            continue
+
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+##############################################################################
+# job kinds
+
+@handler('chesscom_history')
+def import_chesscom_history(job, progress):
+    """fetches a chess.com player's archive into chesscom_games; params are
+    username and optionally year + month to fetch just that month"""
+
+    params = job.params
+    months = None
+    if params.get('year') and params.get('month'):
+        months = [(params['year'], params['month'])]
+
+    added, failed = chesscom.import_history(params['username'], months=months, progress=progress)
+    if months and failed:
+        raise chesscom.ChessComError(f"couldn't fetch {params['username']}'s games for "
+                                     f"{params['year']}/{params['month']:02d}")
+
+    message = f'{added} new games'
+    if failed:
+        message += f", couldn't fetch {len(failed)} months"
+    return message
+
+
+@handler('pgn_upload')
+def import_pgn_upload(job, progress):
+    """posts every game of a .pgn upload spooled by bulk.spool_upload for the
+    job's user, parsing on a PGN_PROCESSES pool; params has the file name.
+    The UploadReport goes on job.result and the spooled file is deleted."""
+
+    config = current_app.config
+    lines = bulk.spooled_lines(job.id, progress)
+
+    try:
+        report = bulk.import_pgn(job.user_id, lines, batch_size=config['UPLOAD_BATCH_SIZE'],
+                                 processes=config['PGN_PROCESSES'])
+    except Exception:
+        db.session.rollback()
+        bulk.discard_upload(job.id)
+        raise
+
+    bulk.discard_upload(job.id)
+    job.result = report.to_dict()
+    return f'{report.added} games added'
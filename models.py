@@ -5,6 +5,10 @@ from sqlite3 import IntegrityError
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+import eco
+import pgn_tools
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -30,7 +34,11 @@ class Like(db.Model):
         db.ForeignKey('games.id', ondelete='cascade')
     )
     
-    __table_args__ = (db.UniqueConstraint(user_id, game_id),)
+    __table_args__ = (
+        db.UniqueConstraint(user_id, game_id),
+        # the unique constraint leads with user_id; feed like counts group by game
+        db.Index('ix_likes_game_id', game_id),
+    )
 
 
 class GameTag(db.Model):
@@ -42,7 +50,14 @@ class GameTag(db.Model):
     tag_id = db.Column(db.Integer, db.ForeignKey("tags.id"), nullable=False)
     game_id = db.Column(db.Integer, db.ForeignKey("games.id"), nullable=False)
 
-    __table_args__ = (db.UniqueConstraint(game_id, tag_id),)
+    # number of game_tag_likes rows, kept in step by the writes in votes.py
+    vote_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        db.UniqueConstraint(game_id, tag_id),
+        # tag search walks games by tag, see feed.tagged_games
+        db.Index('ix_game_tags_tag_id_game_id', tag_id, game_id),
+    )
 
     game_tag_likes = db.relationship("GameTagLikes")
     tags = db.relationship("Tag")
@@ -174,6 +189,16 @@ class User(db.Model):
                 return user
 
         return False
+
+
+def _poster_username(context):
+    """games.username for an insert that didn't give one: the poster's"""
+
+    users = User.__table__
+    user_id = context.get_current_parameters().get('user_id')
+    return context.connection.scalar(db.select([users.c.username]).where(users.c.id == user_id))
+
+
 class Game(db.Model):
     """Each chess Game that has been uploaded or posted"""
 
@@ -193,6 +218,13 @@ class Game(db.Model):
         db.Text, 
         nullable=False)
 
+    # the poster's username, copied on insert (usernames never change) so
+    # the user sort orders can walk an index on games alone
+    username = db.Column(
+        db.Text,
+        default=_poster_username
+    )
+
     pgn = db.Column(
         db.Text, 
         nullable=False
@@ -201,12 +233,139 @@ class Game(db.Model):
     timestamp = db.Column(
     db.DateTime,
     nullable=False,
-    default=datetime.utcnow(),
+    default=datetime.utcnow,
     )
 
+    # number of likes rows, kept in step by votes.like_game / unlike_game
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    # number of game_tags rows, kept in step by the writes in votes.py
+    tag_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    # pgn_tools.movetext_hash of pgn, set through set_pgn()
+    pgn_hash = db.Column(
+        db.String(40)
+    )
+
+    # read from the pgn headers by set_pgn(); null when the header is missing
+    white = db.Column(db.Text)
+    black = db.Column(db.Text)
+    result = db.Column(db.String(7))
+    eco = db.Column(db.String(3))
+    # name of the longest eco.tsv line the game follows; the trie also
+    # fills eco when the header has none
+    opening = db.Column(db.Text)
+    date = db.Column(db.Date)
+    white_elo = db.Column(db.Integer)
+    black_elo = db.Column(db.Integer)
+    time_control = db.Column(db.Text)
+    # counted from the moves, not the PlyCount header
+    ply_count = db.Column(db.Integer)
+    # SAN and UCI per ply with a FEN every few plies, for the viewer; see
+    # pgn_tools.position_at. Deferred so feed pages don't load it
+    moves = db.deferred(db.Column(db.JSON(none_as_null=True)))
+
+    # keyset indexes for the home feed sort orders, see feed.py; the
+    # (user_id, pgn_hash) index also serves lookups of a user's games, and
+    # the header indexes back feed.filtered_games
+    __table_args__ = (
+        db.Index('ix_games_timestamp_id', timestamp, id),
+        db.Index('ix_games_lower_title_id', db.func.lower(title), id),
+        db.Index('ix_games_username_id', db.func.coalesce(username, ''), id),
+        db.Index('ix_games_like_count_id', like_count, id),
+        db.Index('ix_games_tag_count_id', tag_count, id),
+        db.Index('ix_games_user_id_pgn_hash', user_id, pgn_hash, unique=True),
+        db.Index('ix_games_pgn_hash', pgn_hash),
+        db.Index('ix_games_lower_white', db.func.lower(white)),
+        db.Index('ix_games_lower_black', db.func.lower(black)),
+        db.Index('ix_games_result', result),
+        db.Index('ix_games_eco', eco, postgresql_ops={'eco': 'varchar_pattern_ops'}),
+        db.Index('ix_games_opening', opening, postgresql_ops={'opening': 'text_pattern_ops'}),
+        db.Index('ix_games_date', date),
+        db.Index('ix_games_white_elo', white_elo),
+        db.Index('ix_games_black_elo', black_elo),
+    )
+
+    # written whole by set_pgn(); the database deletes them with the game
+    positions = db.relationship('GamePosition', cascade='all, delete-orphan', passive_deletes=True)
+
+    def set_pgn(self, pgn, summary=None):
+        """stores the pgn with its hash, header columns and positions, from
+        `summary` if it was already parsed; raises pgn_tools.InvalidPGN if
+        it can't be read"""
+
+        if summary is None:
+            summary = pgn_tools.summarize(pgn)
+
+        columns = summary._asdict()
+        positions = columns.pop('positions')
+
+        # replacing positions loads the old ones; nothing is flushed until
+        # the caller is ready, so explorer.remove_game still sees the old
+        # result and positions of an edited game
+        with db.session.no_autoflush:
+            for column, value in columns.items():
+                setattr(self, column, value)
+            self.positions = [GamePosition(ply=ply, hash=key, move=move)
+                              for ply, (key, move) in enumerate(positions)]
+            self.pgn = pgn
+
+    @classmethod
+    def find_duplicate(cls, user_id, pgn_hash, exclude_id=None):
+        """the user's game with these moves, other than `exclude_id`, or None"""
+
+        with db.session.no_autoflush:
+            query = cls.query.filter(cls.user_id == user_id, cls.pgn_hash == pgn_hash)
+            if exclude_id is not None:
+                query = query.filter(cls.id != exclude_id)
+            return query.first()
+
     likes = db.relationship('Like', backref='games')
    
     game_tags = db.relationship("GameTag")
+
+
+class GamePosition(db.Model):
+    """one position reached in a game's mainline, keyed by its Zobrist hash
+    (pgn_tools.signed_zobrist) for position search"""
+
+    __tablename__ = 'game_positions'
+
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete='cascade'), primary_key=True)
+    ply = db.Column(db.SmallInteger, primary_key=True)
+    hash = db.Column(db.BigInteger, nullable=False)
+    # SAN of the move played from this position; null for the final one
+    move = db.Column(db.String(10))
+
+    __table_args__ = (
+        db.Index('ix_game_positions_hash_game_id', hash, game_id),
+    )
+
+
+class ExplorerMove(db.Model):
+    """opening explorer totals for one move from one position, over every
+    posted game; kept in step with game_positions by explorer.py"""
+
+    __tablename__ = 'explorer_moves'
+
+    position_hash = db.Column(db.BigInteger, primary_key=True)
+    move = db.Column(db.String(10), primary_key=True)
+    games = db.Column(db.Integer, nullable=False, default=0)
+    white_wins = db.Column(db.Integer, nullable=False, default=0)
+    draws = db.Column(db.Integer, nullable=False, default=0)
+    black_wins = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Tag(db.Model):
 
     __tablename__ = 'tags'
@@ -223,6 +382,176 @@ class Tag(db.Model):
     )
 
 
+class ArchivedGame(db.Model):
+    """a game from a chess.com player's archive, stored when their history
+    is fetched so results can be filtered and paged locally.
+
+    color, result and opponent_rating are from the point of view of
+    `username`, the player whose archive it came from.
+    """
+
+    __tablename__ = 'chesscom_games'
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.Text, nullable=False)
+    uuid = db.Column(db.Text, nullable=False)
+    url = db.Column(db.Text)
+    end_time = db.Column(db.DateTime)
+    time_class = db.Column(db.Text)
+    color = db.Column(db.Text, nullable=False)
+    result = db.Column(db.Text, nullable=False)
+    opponent_rating = db.Column(db.Integer)
+    white_username = db.Column(db.Text, nullable=False)
+    white_rating = db.Column(db.Integer)
+    black_username = db.Column(db.Text, nullable=False)
+    black_rating = db.Column(db.Integer)
+    pgn = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint(username, uuid),
+        db.Index('ix_chesscom_games_username_end_time', username, end_time),
+    )
+
+    # same shape as the chess.com json, so search_games.html renders either
+    @property
+    def white(self):
+        return {'username': self.white_username, 'rating': self.white_rating}
+
+    @property
+    def black(self):
+        return {'username': self.black_username, 'rating': self.black_rating}
+
+
+class ImportJob(db.Model):
+    """a queued background job, a chess.com import or a .pgn upload, run by
+    `flask import-worker` (see jobs.py)"""
+
+    __tablename__ = 'import_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'))
+    kind = db.Column(db.Text, nullable=False)
+    params = db.Column(db.JSON, nullable=False, default=dict)
+
+    # queued -> running -> done / failed
+    status = db.Column(db.Text, nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    message = db.Column(db.Text)
+    result_url = db.Column(db.Text)
+    # what a finished job produced, for the page at result_url
+    result = db.Column(db.JSON)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # doubles as the worker heartbeat, see jobs.claim_next
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_import_jobs_status_id', status, id),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'message': self.message,
+            'result_url': self.result_url,
+        }
+
+
+class UploadChunk(db.Model):
+    """a piece of a .pgn upload waiting for its job; written by the web
+    request, read back in id order and deleted by the worker (see bulk.py)"""
+
+    __tablename__ = 'upload_chunks'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('import_jobs.id', ondelete='cascade'), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (db.Index('ix_upload_chunks_job_id_id', job_id, id),)
+
+
+class CacheVersion(db.Model):
+    """version counter for a process-local cache, bumped when its data changes"""
+
+    __tablename__ = 'cache_versions'
+
+    name = db.Column(db.Text, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def repair_counters():
+    """rebuilds games.like_count, games.tag_count and game_tags.vote_count
+    from the likes, game_tags and game_tag_likes tables, and games.username
+    from users, for rows that drifted or predate the columns"""
+
+    like_count = (db.select([db.func.count(Like.id)])
+                  .where(Like.game_id == Game.id)
+                  .as_scalar())
+    tag_count = (db.select([db.func.count(GameTag.id)])
+                 .where(GameTag.game_id == Game.id)
+                 .as_scalar())
+    username = (db.select([User.username])
+                .where(User.id == Game.user_id)
+                .as_scalar())
+    vote_count = (db.select([db.func.count(GameTagLikes.id)])
+                  .where(GameTagLikes.game_tag_id == GameTag.id)
+                  .as_scalar())
+
+    Game.query.update({Game.like_count: like_count, Game.tag_count: tag_count, Game.username: username},
+                      synchronize_session=False)
+    GameTag.query.update({GameTag.vote_count: vote_count}, synchronize_session=False)
+    db.session.commit()
+
+
+def classify_openings(batch_size=5000):
+    """sets opening (and eco where it is null) on every game from the eco
+    trie, reading the moves already stored in game_positions rather than
+    parsing any pgn; commits every `batch_size` games and returns how many
+    were classified"""
+
+    games = Game.__table__
+    depth = eco.max_depth()
+    moves = aggregate_order_by(GamePosition.move, GamePosition.ply)
+
+    set_opening = (games.update()
+                   .where(games.c.id == db.bindparam('game_id'))
+                   .values(eco=db.func.coalesce(games.c.eco, db.bindparam('trie_eco')),
+                           opening=db.bindparam('trie_opening')))
+
+    classified = 0
+    last_id = 0
+
+    while True:
+        batch = (db.session.query(GamePosition.game_id, db.func.array_agg(moves))
+                 .filter(GamePosition.game_id > last_id)
+                 .filter(GamePosition.ply < depth)
+                 .group_by(GamePosition.game_id)
+                 # games set up from a FEN have no book opening
+                 .having(db.func.bool_or((GamePosition.ply == 0) &
+                                         (GamePosition.hash == pgn_tools.STARTING_HASH)))
+                 .order_by(GamePosition.game_id)
+                 .limit(batch_size)
+                 .all())
+        if not batch:
+            return classified
+
+        params = []
+        for game_id, game_moves in batch:
+            opening = eco.classify(game_moves)
+            if opening is not None:
+                params.append({'game_id': game_id, 'trie_eco': opening.eco, 'trie_opening': opening.name})
+
+        if params:
+            db.session.execute(set_opening, params)
+        classified += len(params)
+        last_id = batch[-1][0]
+        db.session.commit()
+
+
 def connect_db(app):
     """initialize app """
 
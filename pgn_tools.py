@@ -0,0 +1,325 @@
+"""PGN helpers for Chess Byte, built on python-chess.
+
+movetext_hash() identifies a game by its moves alone: tag pairs other than
+the starting position, comments, variations, NAGs, move numbers and spacing
+all drop out, so the same game pasted from two sites hashes the same.
+
+summarize() reads everything the games table keeps about a PGN in one
+parse, so it is done once when a game is saved rather than on every read.
+That includes the Zobrist hash of every position in the mainline, which
+game_positions indexes so a position can be found however it was reached,
+and a move list the viewer can step through without a PGN parser.
+
+Parsing is CPU bound, so bulk callers (uploads, backfills) summarize
+through a Summarizer, which spreads the work over a process pool.
+"""
+
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+from collections import namedtuple
+from datetime import date
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+import eco
+
+
+class InvalidPGN(ValueError):
+    """raised when a PGN can't be read as a game with at least one move"""
+
+
+class _LineReader:
+    """readline() over an iterable of lines, for chess.pgn, keeping the
+    lines read since the last take()"""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._taken = []
+
+    def readline(self):
+        line = next(self._lines, '')
+        if line:
+            self._taken.append(line)
+        return line
+
+    def take(self):
+        text = ''.join(self._taken)
+        self._taken = []
+        return text
+
+
+def split_games(lines):
+    """yields the raw text of each game in a multi-game PGN, read line by
+    line so only one game is held at a time. python-chess decides where
+    each game ends, so every piece is exactly what read_game parses; text
+    it would skip over shows up as that game's error there."""
+
+    reader = _LineReader(lines)
+    while chess.pgn.skip_game(reader):
+        pgn = reader.take().lstrip()
+        if pgn:
+            yield pgn
+
+
+def _stray_text(pgn):
+    """why the movetext of a one game PGN hides more than python-chess
+    reports: another game's tag pairs with no blank line before them, or a
+    {comment} that never closes and so swallows the rest. None if neither"""
+
+    in_comment = in_movetext = False
+    for line in io.StringIO(pgn):
+        if not in_comment:
+            if line.isspace() or line.startswith('%'):
+                continue
+            if line.startswith('['):
+                if in_movetext:
+                    return 'that PGN has more than one game'
+                continue
+        in_movetext = True
+
+        for token in chess.pgn.SKIP_MOVETEXT_REGEX.findall(line):
+            if token == '{':
+                in_comment = True
+            elif token == '}':
+                in_comment = False
+            elif not in_comment:
+                # a ; comment runs to the end of the line
+                break
+
+    if in_comment:
+        return 'that PGN has a {comment} that is never closed'
+    return None
+
+
+class _GameBuilder(chess.pgn.GameBuilder):
+    """collects parse errors on the game without logging a traceback for
+    each one; read_game turns them into InvalidPGN"""
+
+    def handle_error(self, error):
+        self.game.errors.append(error)
+
+
+def read_game(pgn):
+    """parses the one game in `pgn`, raising InvalidPGN if there isn't
+    exactly one"""
+
+    stream = io.StringIO(pgn or '')
+    game = chess.pgn.read_game(stream, Visitor=_GameBuilder)
+    if game is None or game.errors:
+        raise InvalidPGN("couldn't read that PGN")
+    if stream.read().strip():
+        raise InvalidPGN('that PGN has more than one game')
+    stray = _stray_text(pgn)
+    if stray:
+        raise InvalidPGN(stray)
+    if game.next() is None:
+        raise InvalidPGN('that PGN has no moves')
+    return game
+
+
+def signed_zobrist(board):
+    """the board's polyglot Zobrist hash as a signed 64 bit int, so it fits
+    a Postgres BIGINT"""
+
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+STARTING_HASH = signed_zobrist(chess.Board())
+
+
+def position_hash(fen):
+    """signed_zobrist of the position in `fen`; raises ValueError for a bad
+    FEN"""
+
+    return signed_zobrist(chess.Board(fen))
+
+
+# a move list keeps the FEN of every this many plies, so any position is at
+# most this many moves from one
+CHECKPOINT_PLIES = 16
+
+
+def _walk(game):
+    """plays through the mainline once; returns (canonical movetext,
+    positions, move list), where positions has a (Zobrist hash, SAN of the
+    move played from there) pair per ply, starting position first and a None
+    move for the final position. The move list is what position_at reads:
+
+        {'san': [...], 'uci': [...], 'every': CHECKPOINT_PLIES,
+         'checkpoints': [FEN at ply 0, FEN at ply 16, ...]}
+    """
+
+    board = game.board()
+    start = board.fen()
+    parts = [start]
+    positions = []
+    moves = {'san': [], 'uci': [], 'every': CHECKPOINT_PLIES, 'checkpoints': [start]}
+    for ply, move in enumerate(game.mainline_moves(), 1):
+        san = board.san(move)
+        positions.append((signed_zobrist(board), san))
+        parts.append(san)
+        moves['san'].append(san)
+        moves['uci'].append(board.uci(move))
+        board.push(move)
+        if ply % CHECKPOINT_PLIES == 0:
+            moves['checkpoints'].append(board.fen())
+    positions.append((signed_zobrist(board), None))
+    return ' '.join(parts), positions, moves
+
+
+def canonical_movetext(game):
+    """the starting FEN and the mainline in SAN, one space apart"""
+
+    return _walk(game)[0]
+
+
+def _hash(movetext):
+    return hashlib.sha1(movetext.encode('utf-8')).hexdigest()
+
+
+def movetext_hash(pgn):
+    """sha1 hex digest of the game's canonical movetext"""
+
+    return _hash(canonical_movetext(read_game(pgn)))
+
+
+# the games columns filled from a PGN, plus the position hashes for the
+# game_positions rows; see Game.set_pgn
+PGNSummary = namedtuple('PGNSummary', ['pgn_hash', 'white', 'black', 'result', 'eco', 'opening',
+                                       'date', 'white_elo', 'black_elo', 'time_control',
+                                       'ply_count', 'moves', 'positions'])
+
+RESULTS = {'1-0', '0-1', '1/2-1/2'}
+ECO_CODE = re.compile(r'^[A-E][0-9]{2}$')
+
+
+def _name(value):
+    """a header value, or None for the '?' placeholders"""
+
+    value = (value or '').strip()
+    if not value or set(value) <= set('?-'):
+        return None
+    return value
+
+
+def _rating(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _date(value):
+    """a date from a PGN 'YYYY.MM.DD' header; None when any part is unknown"""
+
+    try:
+        year, month, day = (int(part) for part in (value or '').split('.'))
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def classify_opening(game, moves):
+    """eco.classify for a game's SAN moves; None for games that don't start
+    from the initial position"""
+
+    if game.board().fen() != chess.STARTING_FEN:
+        return None
+    return eco.classify(moves)
+
+
+def summarize(pgn):
+    """parses `pgn` once into a PGNSummary; raises InvalidPGN"""
+
+    game = read_game(pgn)
+    headers = game.headers
+    movetext, positions, moves = _walk(game)
+
+    result = headers.get('Result')
+    eco_code = (headers.get('ECO') or '').strip().upper()
+    opening = classify_opening(game, [move for _, move in positions[:-1]])
+
+    return PGNSummary(pgn_hash=_hash(movetext),
+                      white=_name(headers.get('White')),
+                      black=_name(headers.get('Black')),
+                      result=result if result in RESULTS else None,
+                      # the header's code wins, the trie fills it in when missing
+                      eco=eco_code if ECO_CODE.match(eco_code) else (opening and opening.eco),
+                      opening=opening and opening.name,
+                      date=_date(headers.get('Date')),
+                      white_elo=_rating(headers.get('WhiteElo')),
+                      black_elo=_rating(headers.get('BlackElo')),
+                      time_control=_name(headers.get('TimeControl')),
+                      ply_count=len(positions) - 1,
+                      moves=moves,
+                      positions=positions)
+
+
+def position_at(moves, ply):
+    """the FEN after `ply` plies of a move list from _walk, replayed from the
+    checkpoint at or before it, so never more than CHECKPOINT_PLIES - 1
+    moves; raises ValueError for a ply outside the game"""
+
+    if not 0 <= ply <= len(moves['uci']):
+        raise ValueError(f'ply must be between 0 and {len(moves["uci"])}')
+
+    checkpoint = ply // moves['every']
+    board = chess.Board(moves['checkpoints'][checkpoint])
+    for uci in moves['uci'][checkpoint * moves['every']:ply]:
+        board.push_uci(uci)
+    return board.fen()
+
+
+def _summarize_or_error(pgn):
+    """(summary, None) or (None, error message); runs in the pool workers"""
+
+    try:
+        return summarize(pgn), None
+    except InvalidPGN as exc:
+        return None, str(exc)
+
+
+class Summarizer:
+    """summarize() for lists of PGNs on a pool of worker processes.
+
+    Use as a context manager so the pool is shut down. Results always come
+    back in input order; with processes=1 everything runs in this process.
+    The pool never has more workers than cores, and they are spawned rather
+    than forked, so they share no database connections or threads with the
+    process that started them.
+    """
+
+    def __init__(self, processes=None):
+        cores = os.cpu_count() or 1
+        self.processes = max(1, min(processes or cores, cores))
+        self._pool = None
+
+    def __enter__(self):
+        if self.processes > 1:
+            self._pool = multiprocessing.get_context('spawn').Pool(self.processes)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._pool is not None:
+            if exc_type is None:
+                self._pool.close()
+            else:
+                self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def map(self, pgns):
+        """a (summary, error message) pair for each of `pgns`, in order"""
+
+        if self._pool is None:
+            return [_summarize_or_error(pgn) for pgn in pgns]
+
+        # a few chunks per worker keeps them all busy when games vary in length
+        chunksize = max(1, len(pgns) // (self.processes * 4))
+        return self._pool.map(_summarize_or_error, pgns, chunksize)
@@ -1,6 +1,7 @@
 
 from app import db
-from models import User, Game, Tag, GameTag, GameTagLikes, Like
+from models import User, Game, Tag, GameTag, GameTagLikes, Like, repair_counters
+import explorer
 
 ########################################
 ########################################
@@ -191,6 +192,9 @@ Bc5 24.Bxc5 Qxc5 25.h4 Qd4 26.Re1 Qxa4 27.h5 Ng5 28.Qf5 Nxe4
 
 ''')
 
+for game in (game1, game2, game3, game4, game5):
+    game.set_pgn(game.pgn)
+
 db.session.add(game1)
 db.session.add(game2)
 db.session.add(game3)
@@ -277,6 +281,5 @@ db.session.add(like4)
 
 db.session.commit()
 
-
-
-
+repair_counters()
+explorer.rebuild()
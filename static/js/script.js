@@ -1,6 +1,86 @@
 console.log("JAVASCRIPT IS HERE!!")
 
 
+// likes and tag votes go through the JSON api when javascript is on, so a
+// click updates one counter instead of redirecting and re-rendering the feed.
+// if the api call fails the form is submitted the old way.
+
+$(document).on('submit', '.like-form', function(evt){
+  evt.preventDefault()
+  const form = this
+
+  $.ajax({url: $(form).data('api'), method: $(form).data('method'), dataType: 'json'})
+    .done(function(data){
+      $(form).closest('.game-card').find('.like-count').text(data.like_count)
+    })
+    .fail(function(){
+      form.submit()
+    })
+})
+
+$(document).on('submit', '.tag-form', function(evt){
+  evt.preventDefault()
+  const form = this
+  const $select = $(form).find('select[name=tags]')
+  const tagName = $select.find('option:selected').text()
+
+  $.ajax({url: $(form).data('api') + $select.val() + '/vote', method: 'POST', dataType: 'json'})
+    .done(function(data){
+      updateTagBadge($(form).closest('.game-card'), data, tagName)
+    })
+    .fail(function(){
+      form.submit()
+    })
+})
+
+function updateTagBadge($card, data, tagName){
+  const $badges = $card.find('.tag-badges')
+  let $badge = $badges.find('.tag-badge[data-tag-id="' + data.tag_id + '"]')
+
+  if (data.vote_count < 1) {
+    $badge.remove()
+    return
+  }
+
+  if (!$badge.length) {
+    $badge = $('<btn>')
+      .addClass($badges.data('badge-class') + ' tag-badge')
+      .attr('data-tag-id', data.tag_id)
+      .append($('<p>').append($('<strong>').text(tagName), ': ', $('<span class="tag-votes">')))
+    $badges.append($badge)
+  }
+
+  $badge.find('.tag-votes').text(data.vote_count)
+}
+
+// feed cards show a thumbnail of the final position; the pgn viewer is only
+// built for the game that was clicked. without javascript the thumbnail
+// links to the game page.
+
+$(document).on('click', '.game-thumbnail-link', function(evt){
+  evt.preventDefault()
+  const $preview = $(this).closest('.game-preview')
+  const viewer = $preview.find('template.game-viewer')[0]
+
+  $preview.empty().append(document.importNode(viewer.content, true))
+})
+
+// search results list players only; a result's pgn is fetched and put in a
+// viewer when its board is opened
+
+$(document).on('click', '.archive-board-link', function(evt){
+  evt.preventDefault()
+  const $preview = $(this).closest('.archive-preview')
+
+  $.get(this.href, function(pgn){
+    const viewer = document.createElement('ct-pgn-viewer')
+    viewer.setAttribute('board-actions-menu-direction', 'under')
+    viewer.textContent = pgn
+    $preview.empty().append(viewer)
+  }, 'text')
+})
+
+
 
 
 
@@ -0,0 +1,68 @@
+"""Process-local cache of the tag list.
+
+Nearly every page renders the full tag list, and tags only change through
+add_tag. Each worker keeps its own copy, tagged with the version number
+stored in cache_versions. Every TAG_CATALOG_CHECK_SECONDS a request
+compares that number against the database and reloads the tags only if
+another worker has bumped it.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Tag, CacheVersion
+
+CATALOG_NAME = 'tags'
+
+CatalogTag = namedtuple('CatalogTag', ['id', 'name'])
+
+_lock = threading.Lock()
+_cache = {'version': None, 'tags': [], 'checked_at': 0.0}
+
+
+def _stored_version():
+    version = (db.session.query(CacheVersion.version)
+               .filter(CacheVersion.name == CATALOG_NAME)
+               .scalar())
+    return version or 0
+
+
+def get_tags():
+    """the tag list as (id, name) tuples, ordered by id"""
+
+    check_every = current_app.config['TAG_CATALOG_CHECK_SECONDS']
+    now = time.monotonic()
+
+    with _lock:
+        if _cache['version'] is not None and now - _cache['checked_at'] < check_every:
+            return _cache['tags']
+
+        version = _stored_version()
+        if version != _cache['version']:
+            _cache['tags'] = [CatalogTag(id, name) for id, name in
+                              db.session.query(Tag.id, Tag.name).order_by(Tag.id)]
+            _cache['version'] = version
+        _cache['checked_at'] = now
+
+        return _cache['tags']
+
+
+def bump_version():
+    """marks the tag list as changed, in the current transaction.
+
+    Call before committing a tag change; this worker reloads on its next
+    get_tags() and the others within TAG_CATALOG_CHECK_SECONDS.
+    """
+
+    stmt = (insert(CacheVersion.__table__)
+            .values(name=CATALOG_NAME, version=1)
+            .on_conflict_do_update(index_elements=['name'],
+                                   set_={'version': CacheVersion.__table__.c.version + 1}))
+    db.session.execute(stmt)
+
+    with _lock:
+        _cache['version'] = None
@@ -0,0 +1,199 @@
+"""Tests for the home feed: page cursors, and query counts for the feed, the
+likes page and a user's games page, which must take the same number of
+statements however many cards they show. Runs against its own database, recreated for the run:
+
+    TEST_DATABASE_URL=postgresql:///chessbyte_test python -m unittest tests.test_feed
+"""
+
+import base64
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', 'postgresql:///chessbyte_test')
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from models import db, User, Game, Tag, GameTag, Like
+import feed
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_ENABLED'] = False
+# the tag list is checked against cache_versions once per run, so that
+# check never lands inside one of the measured requests
+app.config['TAG_CATALOG_CHECK_SECONDS'] = 24 * 60 * 60
+
+MOVES = 'e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O'.split()
+
+
+def pgn(plies):
+    """a game of the first `plies` moves of MOVES, so each length is a
+    different game to the duplicate check"""
+
+    movetext = ' '.join(f'{n // 2 + 1}. {move}' if n % 2 == 0 else move
+                        for n, move in enumerate(MOVES[:plies]))
+    return f'[Result "*"]\n\n{movetext} *'
+
+# feed.page: the page of games, then every card's tags
+PAGE_QUERIES = 2
+
+
+@contextmanager
+def count_queries():
+    """counts the statements sent to the database inside the block"""
+
+    counter = {'queries': 0}
+
+    def before_cursor_execute(*args):
+        counter['queries'] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class FeedTestCase(TestCase):
+    """feed routes, which load any number of cards in a fixed number of
+    queries"""
+
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            users = [User(username=f'user{n}', email=f'user{n}@test.com', password='password')
+                     for n in range(4)]
+            tags = [Tag(name=f'tag{n}') for n in range(3)]
+            db.session.add_all(users + tags)
+            db.session.flush()
+
+            for n in range(30):
+                game = Game(user_id=users[n % 4].id, title=f'game {n}')
+                game.set_pgn(pgn(n // 4 + 1))
+                db.session.add(game)
+                db.session.flush()
+
+                for tag in tags[:n % 4]:
+                    db.session.add(GameTag(game_id=game.id, tag_id=tag.id, vote_count=n % 3))
+                for user in users[:n % 3]:
+                    db.session.add(Like(user_id=user.id, game_id=game.id))
+                game.like_count = n % 3
+
+            db.session.commit()
+            cls.user_id = users[0].id
+
+    def setUp(self):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+
+    def page_queries(self, sort, per_page):
+        with app.app_context():
+            with count_queries() as counter:
+                games, _ = feed.page(sort, per_page=per_page)
+            db.session.remove()
+        return len(games), counter['queries']
+
+    def test_page_queries_are_constant(self):
+        for sort in feed.SORTS:
+            with self.subTest(sort=sort):
+                self.assertEqual(self.page_queries(sort, 2), (2, PAGE_QUERIES))
+                self.assertEqual(self.page_queries(sort, 25), (25, PAGE_QUERIES))
+
+    def test_tampered_cursor_restarts_the_feed(self):
+        resp = self.client.get('/by_most_likes', query_string={'after': tampered_cursor('lots', 1)})
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(resp.location.endswith('/by_most_likes'))
+
+    def request_queries(self, url):
+        with count_queries() as counter:
+            resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return counter['queries']
+
+    def test_home_route_queries_are_constant(self):
+        self.request_queries('/?per_page=1')
+
+        self.assertEqual(self.request_queries('/?per_page=2'), self.request_queries('/?per_page=25'))
+
+    def test_likes_route_queries_are_constant(self):
+        self.request_queries('/likes')
+        before = self.request_queries('/likes')
+
+        # games by posters the page hasn't loaded yet, which is where a lazy
+        # game.users load per card would show up
+        with app.app_context():
+            for n in range(5):
+                poster = User(username=f'poster{n}', email=f'poster{n}@test.com', password='password')
+                db.session.add(poster)
+                db.session.flush()
+                game = Game(user_id=poster.id, title=f'liked {n}')
+                game.set_pgn(pgn(n + 1))
+                db.session.add(game)
+                db.session.flush()
+                db.session.add(Like(user_id=self.user_id, game_id=game.id))
+                game.like_count = 1
+            db.session.commit()
+
+        self.assertEqual(self.request_queries('/likes'), before)
+
+    def test_user_games_route_queries_are_constant(self):
+        url = f'/games/{self.user_id}/'
+        self.request_queries(url)
+        before = self.request_queries(url)
+
+        # more games, tags and likes on the page, none of which may add a
+        # query per card
+        with app.app_context():
+            tag = Tag.query.first()
+            for n in range(5):
+                game = Game(user_id=self.user_id, title=f'more {n}')
+                game.set_pgn(pgn(n + 10))
+                db.session.add(game)
+                db.session.flush()
+                db.session.add(GameTag(game_id=game.id, tag_id=tag.id, vote_count=1))
+                db.session.add(Like(user_id=self.user_id, game_id=game.id))
+                game.like_count = 1
+            db.session.commit()
+
+        self.assertEqual(self.request_queries(url), before)
+
+
+def tampered_cursor(key, game_id):
+    raw = json.dumps([key, game_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+class FeedCursorTestCase(TestCase):
+    """a cursor only decodes to a key of its sort's type"""
+
+    def test_round_trip(self):
+        posted = datetime(2022, 5, 1, 12, 30, 0, 1)
+        for sort, key in [('newest', posted), ('user_a_z', 'oren'), ('most_likes', 3), ('posted', 7)]:
+            with self.subTest(sort=sort):
+                cursor = feed.encode_cursor(key, 42)
+                self.assertEqual(feed.decode_cursor(cursor, feed.SORTS[sort]), (key, 42))
+
+    def test_rejects_keys_of_the_wrong_type(self):
+        cursors = [
+            ('most_likes', 'lots', 1),
+            ('most_tags', 1.5, 1),
+            ('least_likes', True, 1),
+            ('posted', 2 ** 40, 1),
+            ('newest', 'yesterday', 1),
+            ('oldest', 20220501, 1),
+            ('user_a_z', 5, 1),
+            ('title_a_z', 'a\x00b', 1),
+            ('title_a_z', 'a', '1'),
+            ('title_a_z', 'a', None),
+        ]
+        for sort, key, game_id in cursors:
+            with self.subTest(sort=sort, key=key, game_id=game_id):
+                with self.assertRaises(feed.InvalidCursor):
+                    feed.decode_cursor(tampered_cursor(key, game_id), feed.SORTS[sort])
@@ -0,0 +1,83 @@
+"""Tests for splitting multi-game PGN uploads into games; no database.
+
+    python -m unittest tests.test_pgn_tools
+"""
+
+from unittest import TestCase
+
+import pgn_tools
+
+
+def split(text):
+    return list(pgn_tools.split_games(text.splitlines(True)))
+
+
+def plies(pgn):
+    return pgn_tools.summarize(pgn).ply_count
+
+
+class SplitGamesTestCase(TestCase):
+    """split_games cuts where python-chess ends a game, so every piece
+    parses as one game or fails with its own error"""
+
+    def test_games_with_tag_pairs(self):
+        games = split('[Event "a"]\n[Result "*"]\n\n1. e4 e5 *\n\n[Event "b"]\n\n1. d4 *\n')
+
+        self.assertEqual(games, ['[Event "a"]\n[Result "*"]\n\n1. e4 e5 *\n\n', '[Event "b"]\n\n1. d4 *\n'])
+
+    def test_games_without_tag_pairs(self):
+        self.assertEqual([plies(game) for game in split('1. e4 e5 *\n\n1. d4 d5 2. c4 *')], [2, 3])
+
+    def test_braces_outside_comments_are_ignored(self):
+        texts = [
+            '[Event "a"]\n\n1. e4 ; weird { brace\ne5 *\n\n[Event "b"]\n\n1. d4 *\n',
+            '[Event "x {"]\n\n1. e4 e5 *\n\n[Event "b"]\n\n1. d4 *\n',
+            '1. e4 e5 } *\n\n1. d4 *\n',
+        ]
+        for text in texts:
+            with self.subTest(text=text):
+                self.assertEqual([plies(game) for game in split(text)], [2, 1])
+
+    def test_blank_lines_inside_a_comment(self):
+        games = split('1. e4 {a long\n\nnote} e5 *\n\n1. d4 *\n')
+
+        self.assertEqual([plies(game) for game in games], [2, 1])
+        self.assertEqual(pgn_tools.read_game(games[0]).next().comment, 'a long\n\nnote')
+
+    def test_unclosed_comment_is_an_error(self):
+        games = split('1. e4 {oops e5 *\n\n[Event "b"]\n\n1. d4 *\n')
+
+        self.assertEqual(len(games), 1)
+        with self.assertRaisesRegex(pgn_tools.InvalidPGN, 'never closed'):
+            pgn_tools.summarize(games[0])
+
+    def test_missing_blank_line_between_games_is_an_error(self):
+        games = split('[Event "a"]\n\n1. e4 e5 *\n[Event "b"]\n\n1. d4 d5 *\n')
+
+        with self.assertRaisesRegex(pgn_tools.InvalidPGN, 'more than one game'):
+            pgn_tools.summarize(games[0])
+
+    def test_surrounding_blank_lines_are_dropped(self):
+        self.assertEqual(split('\n\n1. e4 *\n\n\n\n1. d4 *\n\n\n'), ['1. e4 *\n\n', '1. d4 *\n\n'])
+        self.assertEqual(split(''), [])
+        self.assertEqual(split('\n  \n'), [])
+
+    def test_reads_one_game_at_a_time(self):
+        lines = iter('1. e4 *\n\n1. d4 *\n\n1. c4 *\n'.splitlines(True))
+        games = pgn_tools.split_games(lines)
+
+        next(games)
+        self.assertEqual(list(lines), ['1. d4 *\n', '\n', '1. c4 *\n'])
+
+
+class ReadGameTestCase(TestCase):
+    """read_game takes exactly one game"""
+
+    def test_rejects_a_second_game(self):
+        with self.assertRaisesRegex(pgn_tools.InvalidPGN, 'more than one game'):
+            pgn_tools.read_game('1. e4 e5 *\n\n1. d4 d5 *\n')
+
+    def test_clock_comments(self):
+        game = pgn_tools.read_game('[Event "Live Chess"]\n\n1. e4 {[%clk 0:02:59.9]} 1... e5 {[%clk 0:02:58]} *\n')
+
+        self.assertEqual(game.end().ply(), 2)
@@ -0,0 +1,159 @@
+"""Tests for the like and tag vote writes in votes.py, which keep
+like_count, vote_count and tag_count in step with the rows they count.
+Runs against its own database, recreated for the run:
+
+    TEST_DATABASE_URL=postgresql:///chessbyte_test python -m unittest tests.test_votes
+"""
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', 'postgresql:///chessbyte_test')
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app
+from models import db, User, Game, Tag, GameTag, GameTagLikes, Like
+import votes
+
+app.config['TESTING'] = True
+
+
+class VotesTestCase(TestCase):
+    """each test gets a fresh game; users and tags are shared"""
+
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            users = [User(username=f'voter{n}', email=f'voter{n}@test.com', password='password')
+                     for n in range(3)]
+            tags = [Tag(name=f'tag{n}') for n in range(3)]
+            db.session.add_all(users + tags)
+            db.session.commit()
+
+            cls.user_ids = [user.id for user in users]
+            cls.tag_ids = [tag.id for tag in tags]
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        # no set_pgn, so no pgn_hash for the per-user duplicate index to trip on
+        game = Game(user_id=self.user_ids[0], title=self.id(), pgn='1. e4 e5 *')
+        db.session.add(game)
+        db.session.commit()
+        self.game_id = game.id
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def stored(self):
+        """(like_count, tag_count) on the game row, and each tag's
+        (vote_count, number of game_tag_likes rows)"""
+
+        db.session.expire_all()
+        game = Game.query.get(self.game_id)
+        pairs = {}
+        for pair in GameTag.query.filter_by(game_id=self.game_id):
+            pairs[pair.tag_id] = (pair.vote_count,
+                                  GameTagLikes.query.filter_by(game_tag_id=pair.id).count())
+        return game.like_count, game.tag_count, pairs
+
+    def test_like_and_unlike(self):
+        alice, bob, _ = self.user_ids
+
+        self.assertEqual(votes.like_game(alice, self.game_id), (True, True, 1))
+        self.assertEqual(votes.like_game(bob, self.game_id), (True, True, 2))
+        self.assertEqual(votes.like_game(alice, self.game_id), (True, False, 2))
+        self.assertEqual(votes.unlike_game(alice, self.game_id), (False, True, 1))
+        self.assertEqual(votes.unlike_game(alice, self.game_id), (False, False, 1))
+
+        self.assertEqual(self.stored()[0], 1)
+        self.assertEqual(Like.query.filter_by(game_id=self.game_id).count(), 1)
+
+    def test_toggle_tag_vote(self):
+        alice, bob, _ = self.user_ids
+        tag = self.tag_ids[0]
+
+        # first vote creates the pair, and the game gains a tag
+        self.assertEqual(votes.toggle_tag_vote(alice, self.game_id, tag), (True, 1))
+        self.assertEqual(self.stored()[1:], (1, {tag: (1, 1)}))
+
+        # a second user's vote on the existing pair
+        self.assertEqual(votes.toggle_tag_vote(bob, self.game_id, tag), (True, 2))
+        self.assertEqual(self.stored()[1:], (1, {tag: (2, 2)}))
+
+        # voting again takes the vote back
+        self.assertEqual(votes.toggle_tag_vote(bob, self.game_id, tag), (False, 1))
+        self.assertEqual(votes.toggle_tag_vote(alice, self.game_id, tag), (False, 0))
+        self.assertEqual(self.stored()[1:], (1, {tag: (0, 0)}))
+
+        # and again puts it back, on the pair that is still there
+        self.assertEqual(votes.toggle_tag_vote(alice, self.game_id, tag), (True, 1))
+        self.assertEqual(self.stored()[1:], (1, {tag: (1, 1)}))
+
+    def test_toggle_tag_vote_on_a_pair_created_concurrently(self):
+        alice, bob, _ = self.user_ids
+        tag = self.tag_ids[0]
+        params = {'user_id': bob, 'game_id': self.game_id, 'tag_id': tag}
+
+        # another request creates the pair and holds its transaction open,
+        # so alice's statement waits on the insert and can't see the pair
+        other = db.engine.connect()
+        other_tx = other.begin()
+        other.execute(votes.TOGGLE_TAG_VOTE, params)
+
+        result = {}
+
+        def vote():
+            with app.app_context():
+                result['state'] = votes.toggle_tag_vote(alice, self.game_id, tag)
+                db.session.remove()
+
+        voter = threading.Thread(target=vote)
+        voter.start()
+        self.wait_for_lock_wait()
+        other_tx.commit()
+        other.close()
+        voter.join(10)
+
+        self.assertEqual(result['state'], (True, 2))
+        self.assertEqual(self.stored()[1:], (1, {tag: (2, 2)}))
+
+    def wait_for_lock_wait(self):
+        """blocks until some backend is waiting on a row lock"""
+
+        waiting = db.text("SELECT count(*) FROM pg_stat_activity "
+                          "WHERE datname = current_database() AND wait_event_type = 'Lock'")
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with db.engine.connect() as conn:
+                if conn.execute(waiting).scalar():
+                    return
+            time.sleep(0.01)
+        self.fail('the vote never waited on the open transaction')
+
+    def test_toggle_tag_vote_rejects_an_unknown_tag(self):
+        with self.assertRaises(IntegrityError):
+            votes.toggle_tag_vote(self.user_ids[0], self.game_id, max(self.tag_ids) + 100)
+        db.session.rollback()
+
+        self.assertEqual(self.stored()[1:], (0, {}))
+
+    def test_tag_new_game(self):
+        alice, bob, _ = self.user_ids
+        first, second, third = self.tag_ids
+
+        self.assertEqual(votes.tag_new_game(alice, self.game_id, []), 0)
+        self.assertEqual(votes.tag_new_game(alice, self.game_id, [first, second, first]), 2)
+        self.assertEqual(self.stored()[1:], (2, {first: (1, 1), second: (1, 1)}))
+
+        # pairs already on the game are left alone
+        self.assertEqual(votes.tag_new_game(bob, self.game_id, [second, third]), 1)
+        self.assertEqual(self.stored()[1:], (3, {first: (1, 1), second: (1, 1), third: (1, 1)}))
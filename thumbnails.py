@@ -0,0 +1,84 @@
+"""Board thumbnails for Chess Byte.
+
+Feed cards show a small SVG of each game's final position instead of a full
+PGN viewer. A thumbnail is drawn once with chess.svg, from the move list
+stored with the game, and kept on disk under the game id and its pgn hash:
+an edited game gets a new file (and a new URL), and every other request for
+it is a file read.
+"""
+
+import glob
+import hashlib
+import os
+import tempfile
+
+import chess
+import chess.svg
+
+import pgn_tools
+
+SIZE = 240
+
+# how long browsers may keep a thumbnail fetched by its version
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+def version(game):
+    """what a game's thumbnail is keyed on besides its id: the movetext hash,
+    or a hash of the raw pgn for games saved without one"""
+
+    if game.pgn_hash:
+        return game.pgn_hash
+    return hashlib.sha1(game.pgn.encode('utf-8')).hexdigest()
+
+
+def render(game):
+    """SVG of the game's final position with its last move highlighted;
+    raises pgn_tools.InvalidPGN if the move list has to be parsed and can't"""
+
+    moves = game.moves or pgn_tools.summarize(game.pgn).moves
+    ply = len(moves['uci'])
+    board = chess.Board(pgn_tools.position_at(moves, ply))
+    lastmove = chess.Move.from_uci(moves['uci'][-1]) if ply else None
+    return chess.svg.board(board, lastmove=lastmove, size=SIZE, coordinates=False)
+
+
+def _path(cache_dir, game_id, key):
+    return os.path.join(cache_dir, f'{game_id}-{key}.svg')
+
+
+def thumbnail(cache_dir, game):
+    """path of the game's thumbnail in `cache_dir`, drawing it first if it
+    isn't there yet; drawing one drops the game's older thumbnails"""
+
+    path = _path(cache_dir, game.id, version(game))
+    if os.path.exists(path):
+        return path
+
+    svg = render(game)
+
+    # through a temp file so a concurrent request never serves half a board
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(svg)
+    os.replace(tmp_path, path)
+
+    for old in glob.glob(_path(cache_dir, game.id, '*')):
+        if old != path:
+            _remove(old)
+    return path
+
+
+def discard(cache_dir, game_id):
+    """removes a deleted game's thumbnails"""
+
+    for path in glob.glob(_path(cache_dir, game_id, '*')):
+        _remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
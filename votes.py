@@ -0,0 +1,167 @@
+"""Like and tag vote writes for Chess Byte.
+
+Each toggle is a single statement keyed on the table's unique constraint:
+the likes or game_tag_likes row is inserted (or deleted) in a CTE and the
+denormalized like_count / vote_count is bumped in the same statement, only
+when a row actually changed. games.tag_count moves the same way whenever a
+game tag pair is created.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Game, Like, GameTag, GameTagLikes
+
+# liked: the user's like state after the call
+# changed: whether this call inserted or deleted a row
+LikeState = namedtuple('LikeState', ['liked', 'changed', 'like_count'])
+
+games = Game.__table__
+likes = Like.__table__
+game_tags = GameTag.__table__
+game_tag_likes = GameTagLikes.__table__
+
+
+def _bump_like_count(changed_rows, delta):
+    """UPDATE games for the game ids returned by a likes insert/delete CTE"""
+
+    return (games.update()
+            .where(games.c.id.in_(db.select([changed_rows.c.game_id])))
+            .values(like_count=games.c.like_count + delta)
+            .returning(games.c.like_count))
+
+
+def _current_like_count(game_id):
+    return db.session.query(Game.like_count).filter(Game.id == game_id).scalar()
+
+
+def like_game(user_id, game_id):
+    """likes a game for a user; a no-op if they already liked it"""
+
+    inserted = (insert(likes)
+                .values(user_id=user_id, game_id=game_id)
+                .on_conflict_do_nothing(index_elements=[likes.c.user_id, likes.c.game_id])
+                .returning(likes.c.game_id)
+                .cte('inserted'))
+
+    like_count = db.session.execute(_bump_like_count(inserted, 1)).scalar()
+    db.session.commit()
+
+    if like_count is None:
+        return LikeState(liked=True, changed=False, like_count=_current_like_count(game_id))
+    return LikeState(liked=True, changed=True, like_count=like_count)
+
+
+def unlike_game(user_id, game_id):
+    """removes a user's like from a game; a no-op if there wasn't one"""
+
+    deleted = (likes.delete()
+               .where(likes.c.user_id == user_id)
+               .where(likes.c.game_id == game_id)
+               .returning(likes.c.game_id)
+               .cte('deleted'))
+
+    like_count = db.session.execute(_bump_like_count(deleted, -1)).scalar()
+    db.session.commit()
+
+    if like_count is None:
+        return LikeState(liked=False, changed=False, like_count=_current_like_count(game_id))
+    return LikeState(liked=False, changed=True, like_count=like_count)
+
+
+# voted: whether the user's vote is on the game tag after the call
+TagVoteState = namedtuple('TagVoteState', ['voted', 'vote_count'])
+
+
+# One round trip: create the game tag pair if needed (starting at one vote,
+# since a brand new pair can't have a vote to take back), then either delete
+# the user's vote or insert it, and move vote_count to match. A pair created
+# by this statement is invisible to old_pair, so only new_pair sets its count,
+# and only a new pair bumps the game's tag_count.
+TOGGLE_TAG_VOTE = db.text("""
+    WITH new_pair AS (
+        INSERT INTO game_tags (game_id, tag_id, vote_count)
+        VALUES (:game_id, :tag_id, 1)
+        ON CONFLICT (game_id, tag_id) DO NOTHING
+        RETURNING id, vote_count
+    ),
+    counted AS (
+        UPDATE games
+        SET tag_count = tag_count + 1
+        WHERE id = :game_id AND EXISTS (SELECT 1 FROM new_pair)
+    ),
+    old_pair AS (
+        SELECT id FROM game_tags WHERE game_id = :game_id AND tag_id = :tag_id
+    ),
+    removed AS (
+        DELETE FROM game_tag_likes
+        WHERE game_tag_id IN (SELECT id FROM old_pair) AND user_id = :user_id
+        RETURNING id
+    ),
+    added AS (
+        INSERT INTO game_tag_likes (game_tag_id, user_id)
+        SELECT id, :user_id FROM (SELECT id FROM new_pair UNION ALL SELECT id FROM old_pair) AS pair
+        WHERE NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT (game_tag_id, user_id) DO NOTHING
+        RETURNING id
+    ),
+    bumped AS (
+        UPDATE game_tags
+        SET vote_count = vote_count + (SELECT count(*) FROM added) - (SELECT count(*) FROM removed)
+        WHERE id IN (SELECT id FROM old_pair)
+        RETURNING vote_count
+    )
+    SELECT EXISTS (SELECT 1 FROM added) AS voted,
+           coalesce((SELECT vote_count FROM bumped), (SELECT vote_count FROM new_pair)) AS vote_count
+""")
+
+
+def toggle_tag_vote(user_id, game_id, tag_id):
+    """adds the user's vote for a tag on a game, or takes it back if they
+    already voted; creates the game tag pair on first use.
+
+    Raises IntegrityError for an unknown game or tag.
+    """
+
+    params = {'user_id': user_id, 'game_id': game_id, 'tag_id': tag_id}
+
+    voted, vote_count = db.session.execute(TOGGLE_TAG_VOTE, params).first()
+    if vote_count is None:
+        # another request created the pair after this statement's snapshot
+        # was taken; it is committed now, so a second pass finds it
+        voted, vote_count = db.session.execute(TOGGLE_TAG_VOTE, params).first()
+    db.session.commit()
+
+    return TagVoteState(voted=voted, vote_count=vote_count)
+
+
+def tag_new_game(user_id, game_id, tag_ids):
+    """tags a freshly posted game with every tag in `tag_ids`, each starting
+    with the poster's vote.
+
+    Two multi-row inserts and a tag_count update in one transaction, however
+    many tags were picked.
+    Pairs that already exist are left alone. Returns how many were added;
+    raises IntegrityError for an unknown game or tag.
+    """
+
+    tag_ids = sorted(set(tag_ids))
+    if not tag_ids:
+        return 0
+
+    pairs = (insert(game_tags)
+             .values([{'game_id': game_id, 'tag_id': tag_id, 'vote_count': 1} for tag_id in tag_ids])
+             .on_conflict_do_nothing(index_elements=[game_tags.c.game_id, game_tags.c.tag_id])
+             .returning(game_tags.c.id))
+    game_tag_ids = [row.id for row in db.session.execute(pairs)]
+
+    if game_tag_ids:
+        db.session.execute(game_tag_likes.insert().values(
+            [{'game_tag_id': game_tag_id, 'user_id': user_id} for game_tag_id in game_tag_ids]))
+        db.session.execute(games.update()
+                           .where(games.c.id == game_id)
+                           .values(tag_count=games.c.tag_count + len(game_tag_ids)))
+
+    db.session.commit()
+    return len(game_tag_ids)